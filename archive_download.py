@@ -0,0 +1,370 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing import Process, Queue
+from queue import Empty
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from blob_store import BlobStore
+from metrics import Metrics
+from resumable import part_file
+from retry import RetryPolicy, s3_retryable
+
+MB = 1024 * 1024
+DONE = "DONE"
+# journal of queued files kept in the output folder
+QUEUE_STATE_FILE = ".archive_queue.sqlite"
+# erases the progress line so a log message can be written in its place
+CLEAR_LINE = "\r\033[K"
+
+# each worker process gets its own copy when it is started
+s3_retry = RetryPolicy("S3 archive", s3_retryable)
+
+
+class ArchiveDownloader:
+    """
+    Downloads recording files from the S3 archive on worker processes. Each worker
+    builds its own boto3 client from s3_config, as clients shouldn't be used across
+    a fork, and downloads objects with the given TransferConfig settings. put blocks
+    once max_queued files are waiting for a worker.
+
+    Workers report the bytes and seconds taken for every object, which are logged
+    every metrics_interval seconds. With progress pending, in flight and done counts
+    are redrawn on stderr every second, below any log messages.
+
+    If state_file is given queued files are journaled in it until they are saved or
+    fail with an error retrying won't fix, so files still pending after a crash or a
+    transient failure are queued again by start
+    """
+
+    def __init__(
+        self,
+        s3_config,
+        bucket,
+        num_processes=8,
+        max_queued=1000,
+        transfer_settings=None,
+        blob_store_dir=None,
+        metrics_interval=60,
+        state_file=None,
+        progress=False,
+    ):
+        self._queue = Queue(maxsize=max_queued)
+        self._stats = Queue()
+        self.metrics = Metrics()
+        self.metrics.set_gauge("queue_depth", self._queue.qsize)
+        self.metrics.set_gauge("pending", self.pending)
+        self.metrics.set_gauge("in_flight", self.in_flight)
+        self.metrics_interval = metrics_interval
+        self.state = None
+        self._resume = []
+        if state_file is not None:
+            self.state = QueueState(state_file)
+            # read before any shards are forked and start journaling new files
+            self._resume = self.state.pending()
+        self.progress = progress
+        self._clear_line = ClearLine(sys.stderr)
+        if progress:
+            # added before any processes are forked so their messages clear it too
+            for handler in stderr_handlers():
+                handler.addFilter(self._clear_line)
+        self._stopped = threading.Event()
+        self._display_thread = threading.Thread(target=self._display, daemon=True)
+        self._processes = [
+            Process(
+                target=save_file_process,
+                args=(
+                    self._queue,
+                    self._stats,
+                    s3_config,
+                    bucket,
+                    transfer_settings or {},
+                    blob_store_dir,
+                ),
+            )
+            for _ in range(num_processes)
+        ]
+        self._stats_thread = threading.Thread(target=self._collect_stats, daemon=True)
+
+    def start(self):
+        for p in self._processes:
+            p.start()
+        self._stats_thread.start()
+        self.metrics.start(self.metrics_interval)
+        if self.progress:
+            self._display_thread.start()
+        if self._resume:
+            logging.info("Resuming %s files pending from last run", len(self._resume))
+            for data in self._resume:
+                # saved just before the crash, after which the journal wasn't updated
+                if os.path.exists(data[0]):
+                    self.state.remove(data[0])
+                else:
+                    self._put(data)
+
+    def put(self, filename, key, file_hash=None):
+        """Queues a file, blocking while the queue is full. Files already queued
+        are ignored"""
+        data = (filename, key, file_hash)
+        if self.state is not None and not self.state.add(data):
+            return
+        self._put(data)
+
+    def _put(self, data):
+        self.metrics.inc("queued")
+        self._queue.put(data)
+
+    def receive(self, queue, senders):
+        """Queues files sent over queue by RemoteArchives in the senders processes,
+        until each has sent DONE or exited. RemoteArchives journal the files they
+        send themselves"""
+        done = 0
+        while done < len(senders):
+            try:
+                data = queue.get(timeout=1)
+            except Empty:
+                # a killed sender never sends DONE
+                if not any(p.is_alive() for p in senders):
+                    logging.error(
+                        "%s senders exited without finishing", len(senders) - done
+                    )
+                    return
+                continue
+            if data == DONE:
+                done += 1
+            else:
+                self._put(data)
+
+    def pending(self):
+        return self.metrics.count("queued") - self.metrics.count("started")
+
+    def in_flight(self):
+        return self.metrics.count("started") - self.metrics.count("finished")
+
+    def stop(self):
+        """Waits for queued files to be downloaded then stops the workers"""
+        for _ in self._processes:
+            self._queue.put(DONE)
+        for p in self._processes:
+            p.join()
+        self._shutdown()
+
+    def cancel(self):
+        """Stops the workers without waiting for queued files, which stay journaled
+        so they are downloaded on resume"""
+        for p in self._processes:
+            p.terminate()
+        for p in self._processes:
+            p.join()
+        # a worker terminated mid put can leave the queues locked, so exit without
+        # flushing them and only wait a while for the stats thread
+        self._queue.cancel_join_thread()
+        self._stats.cancel_join_thread()
+        self._shutdown(timeout=5)
+
+    def _shutdown(self, timeout=None):
+        self._stats.put(DONE)
+        self._stats_thread.join(timeout)
+        self._stopped.set()
+        if self.progress:
+            self._display_thread.join()
+            for handler in stderr_handlers():
+                handler.removeFilter(self._clear_line)
+        self.metrics.stop()
+        if self.state is not None and not self._stats_thread.is_alive():
+            self.state.close()
+
+    def _display(self):
+        while True:
+            stopped = self._stopped.wait(1)
+            sys.stderr.write(
+                f"{CLEAR_LINE}pending {self.pending()} in flight {self.in_flight()} "
+                f"done {self.metrics.count('processed')} "
+                f"failed {self.metrics.count('failed')}"
+            )
+            if stopped:
+                sys.stderr.write("\n")
+                return
+            sys.stderr.flush()
+
+    def _collect_stats(self):
+        while True:
+            stat = self._stats.get()
+            if stat == DONE:
+                break
+            result, filename, size, seconds = stat
+            if result == "started":
+                self.metrics.inc("started")
+                continue
+            self.metrics.inc("finished")
+            # transient failures stay in the journal to be retried on resume
+            if result != "failed" and self.state is not None:
+                self.state.remove(filename)
+            if result == "downloaded":
+                self.metrics.inc("bytes", size)
+                self.metrics.observe("archive", seconds)
+            self.metrics.inc(result)
+            # fatal failures are counted as failed too
+            if result == "fatal":
+                self.metrics.inc("failed")
+            elif result != "failed":
+                self.metrics.inc("processed")
+
+
+class RemoteArchive:
+    """
+    Stands in for the ArchiveDownloader in another process, sending files over queue
+    to ArchiveDownloader.receive. Files are journaled in state_file before they are
+    sent, so once put returns the file will be downloaded even if either process dies
+    """
+
+    def __init__(self, queue, state_file=None):
+        self._queue = queue
+        self.state = None
+        if state_file is not None:
+            self.state = QueueState(state_file)
+
+    def put(self, filename, key, file_hash=None):
+        data = (filename, key, file_hash)
+        if self.state is not None and not self.state.add(data):
+            return
+        self._queue.put(data)
+
+    def close(self):
+        if self.state is not None:
+            self.state.close()
+
+
+def save_file_process(
+    queue, stats, s3_config, bucket, transfer_settings, blob_store_dir=None
+):
+    s3 = boto3.client("s3", **s3_config)
+    transfer_config = TransferConfig(**transfer_settings)
+    blob_store = None
+    if blob_store_dir is not None:
+        blob_store = BlobStore(blob_store_dir)
+    while True:
+        data = queue.get()
+        if data == DONE:
+            break
+        stats.put(("started", data[0], 0, 0))
+        start = time.time()
+        try:
+            result = save_rec_file(s3, bucket, transfer_config, data, blob_store)
+        except Exception as e:
+            logging.error("Could not save rec %s", data[1], exc_info=True)
+            # missing or forbidden objects would fail the same way on every resume
+            result = "failed" if archive_retryable(e) else "fatal"
+        size = 0
+        if result == "downloaded":
+            size = os.path.getsize(data[0])
+        seconds = time.time() - start
+        logging.debug("%s %s %s bytes in %.2fs", result, data[1], size, seconds)
+        stats.put((result, data[0], size, seconds))
+
+
+def archive_retryable(error):
+    """Transient S3 errors and local errors such as a full disk are worth retrying
+    on resume"""
+    return s3_retryable(error) or isinstance(error, OSError)
+
+
+def save_rec_file(s3, bucket, transfer_config, data, blob_store=None):
+    """Saves an archive object to filename, returns "linked" if it was linked from
+    the blob store or "downloaded" """
+    filename, key, file_hash = data
+    use_store = blob_store is not None and file_hash is not None
+    if use_store and blob_store.link(file_hash, filename):
+        return "linked"
+    s3_retry.call(download_archive_file, s3, bucket, key, filename, transfer_config)
+    if use_store:
+        blob_store.add(file_hash, filename, verify=True)
+    return "downloaded"
+
+
+def download_archive_file(s3, bucket, key, filename, transfer_config):
+    """Downloads into a part file renamed into place when complete, so a failed
+    download is never taken as an existing file"""
+    part = part_file(filename)
+    try:
+        with open(part, "wb") as f:
+            s3.download_fileobj(bucket, key, f, Config=transfer_config)
+    except:
+        part.unlink(missing_ok=True)
+        raise
+    os.replace(part, filename)
+
+
+class ClearLine(logging.Filter):
+    """Clears the progress line before a log message is written over it, the next
+    redraw puts it back below the message"""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def filter(self, record):
+        self.stream.write(CLEAR_LINE)
+        return True
+
+
+def stderr_handlers():
+    return [
+        handler
+        for handler in logging.getLogger().handlers
+        if getattr(handler, "stream", None) is sys.stderr
+    ]
+
+
+class QueueState:
+    """
+    SQLite journal of files queued for download and not yet saved
+    """
+
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(filename), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending ("
+                "filename TEXT PRIMARY KEY, key TEXT NOT NULL, hash TEXT)"
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, data):
+        """Journals a queued file, returns False if it is already pending"""
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO pending (filename, key, hash) VALUES (?, ?, ?)",
+                data,
+            )
+            return cur.rowcount > 0
+
+    def remove(self, filename):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM pending WHERE filename = ?", (filename,))
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT filename, key, hash FROM pending"
+            ).fetchall()
+
+
+def transfer_settings(multipart_threshold, multipart_chunksize, max_concurrency):
+    """TransferConfig keyword arguments from sizes in MB, sent to each worker"""
+    return {
+        "multipart_threshold": multipart_threshold * MB,
+        "multipart_chunksize": multipart_chunksize * MB,
+        "max_concurrency": max_concurrency,
+        "use_threads": max_concurrency > 1,
+    }
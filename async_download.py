@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from urllib.parse import urljoin
+
+import aiohttp
+from cacophonyapi.apibase import APIBase
+
+from resumable import (
+    CHUNK_SIZE,
+    part_file,
+    range_headers,
+    expected_size,
+    finish_part,
+    IncompleteDownloadError,
+)
+
+
+class AsyncDownloader:
+    """
+    Downloads recordings with asyncio, sharing one keep-alive connection pool.
+    At most max_requests recordings are in flight, the query producer waits for a
+    free slot before adding more
+    """
+
+    def __init__(self, downloader, api, out_base, max_requests):
+        self.downloader = downloader
+        self.api = api
+        self.out_base = out_base
+        self.max_requests = max_requests
+
+    async def run(self, pages):
+        """Downloads every recording in pages, an iterator of lists of query rows.
+        Pages are fetched on a separate thread so querying doesn't block downloads"""
+        pages = iter(pages)
+        connector = aiohttp.TCPConnector(limit=self.max_requests)
+        timeout = aiohttp.ClientTimeout(sock_read=APIBase.DOWNLOAD_TIMEOUT)
+        in_flight = asyncio.Semaphore(self.max_requests)
+        tasks = set()
+        self.downloader.metrics.set_gauge("queue_depth", lambda: len(tasks))
+        async with aiohttp.ClientSession(
+            headers=self.api._auth_header, connector=connector, timeout=timeout
+        ) as session:
+            while True:
+                rows = await asyncio.to_thread(next, pages, None)
+                if rows is None:
+                    break
+                for row in rows:
+                    await in_flight.acquire()
+                    task = asyncio.create_task(self._download_row(session, row))
+                    task.add_done_callback(lambda _: in_flight.release())
+                    task.add_done_callback(tasks.discard)
+                    tasks.add(task)
+                logging.info("Added %s recordings to async downloader", len(rows))
+            if tasks:
+                await asyncio.gather(*tasks)
+
+    async def _download_row(self, session, r):
+        try:
+            await self._download(session, r)
+            self.downloader.metrics.inc("processed")
+        except Exception:
+            # CancelledError isn't an Exception, so cancelled downloads still cancel
+            logging.error("Error downloading rec %s", r["id"], exc_info=True)
+            self.downloader.metrics.inc("failed")
+
+    async def _download(self, session, r):
+        d = self.downloader
+        prepared = d._prepare(r)
+        if prepared is None:
+            return
+        file_base, extension, tracker_version = prepared
+        # file system, manifest and blob store work runs on threads so it doesn't
+        # stall other downloads
+        out_dir = await asyncio.to_thread(d._make_out_dir, r, file_base, self.out_base)
+        fullpath = out_dir / file_base
+        if d._needs_tracks(fullpath):
+            with d.metrics.time("tracks"):
+                tracks = await d.api_retry.call_async(
+                    self._get_json, session, f"/api/v1/recordings/{r['id']}/tracks"
+                )
+            r["Tracks"] = tracks.get("tracks")
+        if not d.only_metadata:
+            out_file = fullpath.with_suffix(extension)
+            if not out_file.exists() and not await asyncio.to_thread(
+                d._link_from_store, r, out_file
+            ):
+                logging.info("Downloading %s", file_base)
+                with d.metrics.time("raw"):
+                    await d.api_retry.call_async(
+                        self._download_recording,
+                        session,
+                        r["id"],
+                        "downloadRawJWT",
+                        out_file,
+                        r.get("fileHash"),
+                    )
+                d.metrics.inc("bytes", out_file.stat().st_size)
+                logging.info("%s [%s]", out_file.name, out_dir)
+                await asyncio.to_thread(d._add_to_manifest, out_file, r.get("fileHash"))
+                await asyncio.to_thread(d._add_to_store, r, out_file)
+
+        if d.include_mp4:
+            out_file = fullpath.with_suffix(".mp4")
+            if not out_file.exists():
+                with d.metrics.time("mp4"):
+                    await d.api_retry.call_async(
+                        self._download_recording,
+                        session,
+                        r["id"],
+                        "downloadFileJWT",
+                        out_file,
+                    )
+                d.metrics.inc("bytes", out_file.stat().st_size)
+                logging.info("%s [%s]", out_file.name, out_dir)
+                await asyncio.to_thread(d._add_to_manifest, out_file)
+
+        await asyncio.to_thread(
+            d._save_metadata, r, fullpath, self.api._baseurl, tracker_version
+        )
+
+    async def _get_json(self, session, path, params=None):
+        async with session.get(
+            urljoin(self.api._baseurl, path), params=params
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _download_recording(
+        self, session, recording_id, jwt_key, out_file, file_hash=None
+    ):
+        """Makes one attempt at downloading a recording file through a signed url into
+        a .part file, same as download_part in cptv-download.py"""
+        recording = await self._get_json(session, f"/api/v1/recordings/{recording_id}")
+        part = part_file(out_file)
+        offset, headers = range_headers(part)
+        async with session.get(
+            urljoin(self.api._baseurl, "/api/v1/signedUrl"),
+            params={"jwt": recording[jwt_key]},
+            headers=headers,
+        ) as response:
+            if response.status == 416:
+                part.unlink()
+                raise IncompleteDownloadError(
+                    f"{part} is no longer valid for this recording, restarting"
+                )
+            response.raise_for_status()
+            if response.status != 206:
+                offset = 0
+            size = expected_size(response.headers, offset)
+            # file io and hashing run on threads so they don't stall other downloads
+            f = await asyncio.to_thread(open, part, "ab" if offset > 0 else "wb")
+            try:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        await asyncio.to_thread(finish_part, part, out_file, size, file_hash)
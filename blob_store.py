@@ -0,0 +1,56 @@
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from resumable import sha1_file
+
+
+class BlobStore:
+    """
+    Content addressed store of recording files keyed by their fileHash (sha1).
+    Output folders get hardlinks to the stored blobs so a file shared by several
+    output folders or servers is only downloaded and stored once
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, file_hash):
+        return self.root / file_hash[:2] / file_hash
+
+    def link(self, file_hash, filename):
+        """Links filename to the stored blob, returns False if it isn't stored"""
+        blob = self.path(file_hash)
+        if not blob.exists():
+            return False
+        link_or_copy(blob, filename)
+        return True
+
+    def add(self, file_hash, filename, verify=False):
+        """Adds a downloaded file to the store, if verify is set the file is only
+        stored if its sha1 matches file_hash"""
+        blob = self.path(file_hash)
+        if blob.exists():
+            return
+        if verify and sha1_file(filename) != file_hash:
+            logging.warning(
+                "Not storing %s as it doesn't match %s", filename, file_hash
+            )
+            return
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            link_or_copy(filename, blob)
+        except FileExistsError:
+            # stored by another worker in the meantime
+            pass
+
+
+def link_or_copy(source, target):
+    """Hardlinks source to target, copying if they are on different file systems"""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        raise
+    except OSError:
+        shutil.copy2(source, target)
@@ -12,17 +12,49 @@ from pathlib import Path
 import logging
 from dateutil.parser import parse as parse_date
 import gzip
-import io
 import json
 from psycopg2.extras import RealDictCursor
-from multiprocessing import Pool, Process, Queue
 import time
+import threading
+import tracemalloc
+
+from positions import Positions
+from sidecar import save_sidecar, SIDECAR_EXT
+from pool import Pool
+from queries import Queries
+from metrics import Metrics
+from multiprocessing import Process, Queue
+from archive_download import (
+    ArchiveDownloader,
+    RemoteArchive,
+    transfer_settings,
+    QUEUE_STATE_FILE,
+    DONE,
+)
+from retry import RetryPolicy, s3_retryable, db_retryable
 
 HOST_NAME = socket.gethostname()
 CONFIG_FILE = "./config.yaml"
 DUMP_EXT = ".pgdump"
+# last recording whose metadata is written and files are queued, in the out folder
+CHECKPOINT_FILE = ".export_checkpoint.json"
+SHARD_CHECKPOINT_FILE = ".export_checkpoint.{shard}-of-{shards}.json"
+# end date shared by all the shards of a date sharded export
+SHARD_RUN_FILE = ".export_shards.{shards}.json"
 OLD_TRACKER = parse_date("2021-06-01 17:02:30.592 +1200")
 
+# seeks past the last recording of the previous page, matches the queries order by
+KEYSET_CLAUSE = """
+			and ("Recording"."recordingDateTime", "Recording"."id") < (%(after_time)s, %(after_id)s)"""
+
+# select one shard of the recordings for a sharded export
+SHARD_ID_CLAUSE = """
+			and "Recording"."id" %% %(shards)s = %(shard)s"""
+SHARD_FROM_CLAUSE = """
+			and "Recording"."recordingDateTime" >= %(shard_from)s"""
+SHARD_TO_CLAUSE = """
+			and "Recording"."recordingDateTime" < %(shard_to)s"""
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -35,6 +67,100 @@ def parse_args():
         "--start-date",
         help="If specified, only files recorded on or after this date will be downloaded.",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Stream recordings from a server side cursor instead of querying in pages",
+    )
+    parser.add_argument(
+        "--itersize",
+        type=int,
+        default=2000,
+        help="Number of rows to fetch per round trip when streaming",
+    )
+    parser.add_argument(
+        "--track-workers",
+        type=int,
+        default=16,
+        help="Number of threads used to fetch track data from s3",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        default=False,
+        help="Log peak memory used decoding each tracks data, decodes run one at a time",
+    )
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        default=False,
+        help="Also save track positions as typed arrays in a .npz file next to each recording",
+    )
+    parser.add_argument(
+        "--blob-store",
+        help="Folder of recordings stored by fileHash, downloads are hardlinked from here",
+    )
+    parser.add_argument(
+        "--archive-processes",
+        type=int,
+        default=8,
+        help="Number of processes downloading recording files from the s3 archive",
+    )
+    parser.add_argument(
+        "--archive-queue",
+        type=int,
+        default=1000,
+        help="Maximum recording files waiting for an archive process before querying waits",
+    )
+    parser.add_argument(
+        "--multipart-threshold",
+        type=int,
+        default=8,
+        help="Size in MB above which archive files are downloaded in parts",
+    )
+    parser.add_argument(
+        "--multipart-chunksize",
+        type=int,
+        default=8,
+        help="Size in MB of each part of a multipart archive download",
+    )
+    parser.add_argument(
+        "--transfer-concurrency",
+        type=int,
+        default=10,
+        help="Number of threads each archive process downloads parts of a file with",
+    )
+    parser.add_argument(
+        "--progress",
+        action=argparse.BooleanOptionalAction,
+        default=sys.stderr.isatty(),
+        help="Show pending, in flight and done archive downloads, on by default in a terminal",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of processes exporting a shard of the recordings each, on their own connection",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=["id", "date"],
+        default="id",
+        help="Shard recordings by id modulo the number of shards or by equal date ranges",
+    )
+    parser.add_argument(
+        "--explain-queries",
+        action="store_true",
+        default=False,
+        help="Log the planning and execution times and slowest plan nodes of the first run of each query",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Continue a previous export of the same type and start date from its checkpoint",
+    )
     parser.add_argument("out_folder", help="Root folder to place downloaded files in.")
     args = parser.parse_args()
     return args
@@ -60,7 +186,10 @@ def connect_to_db():
     return None
 
 
-s3_archive_bucket = None
+trace_track_memory = False
+track_memory_lock = threading.Lock()
+s3_retry = RetryPolicy("S3", s3_retryable)
+db_retry = RetryPolicy("Postgres", db_retryable)
 
 
 def init_logging():
@@ -93,14 +222,97 @@ def main():
     s3_config = config["s3_auth"]
     bucket_name = s3_config["bucket"]
     del s3_config["bucket"]
-    s3 = boto3.resource("s3", **s3_config)
 
     s3_archive_config = config["s3_archive_auth"]
     archive_bucket = s3_archive_config["bucket"]
     del s3_archive_config["bucket"]
-    s3_archive = boto3.resource("s3", **s3_archive_config)
-    global s3_archive_bucket
-    s3_archive_bucket = s3_archive.Bucket(archive_bucket)
+    if args.trace_memory:
+        global trace_track_memory
+        trace_track_memory = True
+        tracemalloc.start()
+    # each archive worker process builds its own client from the config
+    archive = ArchiveDownloader(
+        s3_archive_config,
+        archive_bucket,
+        num_processes=args.archive_processes,
+        max_queued=args.archive_queue,
+        transfer_settings=transfer_settings(
+            args.multipart_threshold,
+            args.multipart_chunksize,
+            args.transfer_concurrency,
+        ),
+        blob_store_dir=args.blob_store,
+        state_file=download_dir / QUEUE_STATE_FILE,
+        progress=args.progress,
+    )
+    if args.shards <= 1:
+        archive.start()
+        try:
+            export(args, s3_config, bucket_name, download_dir, archive)
+        except BaseException:
+            # the workers aren't daemons, left running they would block exit
+            archive.cancel()
+            raise
+        archive.stop()
+        return
+
+    files = Queue(maxsize=args.archive_queue)
+    end_date = None
+    if args.shard_by == "date":
+        end_date = shard_end_date(download_dir, args, parse_date(args.start_date))
+    shards = []
+    for shard in range(args.shards):
+        p = Process(
+            target=export_shard,
+            args=(args, s3_config, bucket_name, download_dir, files, shard, end_date),
+        )
+        p.start()
+        shards.append(p)
+    # shards are forked first so they don't inherit the archive downloaders threads
+    archive.start()
+    try:
+        archive.receive(files, shards)
+    except BaseException:
+        for p in shards:
+            p.terminate()
+        archive.cancel()
+        raise
+    for p in shards:
+        p.join()
+    archive.stop()
+    failed = [shard for shard, p in enumerate(shards) if p.exitcode != 0]
+    if failed:
+        logging.error("Shards %s failed, rerun with --resume to continue them", failed)
+        sys.exit(1)
+
+
+def export_shard(args, s3_config, bucket_name, download_dir, files, shard, end_date):
+    """Exports one shard in a worker process, journaling recording files to download
+    and sending them back to the main process"""
+    archive = RemoteArchive(files, download_dir / QUEUE_STATE_FILE)
+    try:
+        export(
+            args,
+            s3_config,
+            bucket_name,
+            download_dir,
+            archive,
+            shard,
+            end_date,
+        )
+    finally:
+        archive.close()
+        files.put(DONE)
+
+
+def export(
+    args, s3_config, bucket_name, download_dir, archive, shard=None, end_date=None
+):
+    """Exports all recordings, or one shard of them, on its own database connection
+    writing the metadata and queueing the recording files on archive"""
+    name = "Export" if shard is None else f"Shard {shard}"
+    # clients are thread safe so one is shared by all track data threads
+    s3 = boto3.client("s3", **s3_config)
     conn = connect_to_db()
     with open("tagged_recordings.sql", "r") as f:
         taggedthermals_sql = f.read()
@@ -109,98 +321,301 @@ def main():
         tracks_sql = f.read()
 
     start_date = parse_date(args.start_date)
+    checkpoint_file = download_dir / CHECKPOINT_FILE
+    shard_info = None
+    shard_filter = ("", {})
+    if shard is not None:
+        checkpoint_file = download_dir / SHARD_CHECKPOINT_FILE.format(
+            shard=shard, shards=args.shards
+        )
+        shard_info = {
+            "by": args.shard_by,
+            "shard": shard,
+            "shards": args.shards,
+            "end_date": None if end_date is None else end_date.isoformat(),
+        }
+        shard_filter = shard_clause(
+            args.shard_by, shard, args.shards, start_date, end_date
+        )
+    last_key = None
+    if args.resume:
+        last_key = resume_key(checkpoint_file, args.type, start_date, shard_info)
     limit = 200
-    offset = 0
     cur = conn.cursor(cursor_factory=RealDictCursor)
+    queries = Queries(conn, args.explain_queries)
+    metrics = Metrics()
     saved = 0
-    recs = {}
-    s3_queue = Queue()
-    num_processes = 8
-    processes = []
-    for i in range(num_processes):
-        p = Process(
-            target=save_file_process,
-            args=(s3_queue,),
-        )
-        processes.append(p)
-        p.start()
 
-    while True:
-        query_sql = taggedthermals_sql.format(args.type, start_date, limit, offset)
-        cur.execute(query_sql)
-        logging.info("Querying offset %s limit %s", limit, offset)
-        rec_rows = cur.fetchall()
-        if rec_rows is None or len(rec_rows) == 0:
-            logging.info("Finished")
-            break
-        for rec_row in rec_rows:
-            if rec_row["id"] in recs:
-                if rec_row["Tags.id"] is not None:
-                    existing_rec = recs[rec_row["id"]]
-                    if "tags" not in existing_rec:
-                        existing_rec["tags"] = []
-                    tag = map_recording_tag(rec_row)
-                    existing_rec["tags"].append(tag)
-                continue
-
-            # save any recordings as we are now on new rec
-            for rec in recs.values():
-                save_rec(rec, download_dir, s3_queue, args.type)
+    if args.stream:
+        pages = stream_recording_pages(
+            conn,
+            taggedthermals_sql,
+            args.type,
+            start_date,
+            limit,
+            args.itersize,
+            last_key,
+            shard_filter,
+        )
+    else:
+        pages = query_recording_pages(
+            queries,
+            cur,
+            taggedthermals_sql,
+            args.type,
+            start_date,
+            limit,
+            last_key,
+            shard_filter,
+        )
+    # a failed query or Ctrl-C cancels the queued track requests
+    with Pool(args.track_workers) as track_pool:
+        for rec_rows in pages:
+            # fetch tracks for every recording in this page with one query
+            rec_ids = {rec_row["id"] for rec_row in rec_rows}
+            rec_tracks = get_tracks_for_recordings(
+                queries, cur, tracks_sql, rec_ids, track_pool, s3, bucket_name, metrics
+            )
+            for rec in group_recordings(rec_rows, rec_tracks).values():
+                save_rec(rec, download_dir, archive, args.type, args.sidecar)
                 saved += 1
                 if saved % 100 == 0:
-                    logging.info("Saved %s", saved)
-            recs = {}
-            track_q = tracks_sql.format(rec_row["id"])
-            cur.execute(track_q)
-            tracks_rows = cur.fetchall()
-
-            tracks = {}
-            for track_row in tracks_rows:
-                track_id = track_row["id"]
-                if track_id in tracks:
-                    tag = map_track_tag(track_row)
-                    tracks[track_id]["tags"].append(tag)
-                else:
-                    track_data = get_track_data(s3, bucket_name, track_row["id"])
-                    if track_data is not None:
-                        track_row["data"] = track_data
-                    mapped_track = map_track(track_row)
-                    tracks[track_id] = mapped_track
-
-            recording = map_recording(rec_row)
-            recording["tracks"] = list(tracks.values())
-            recs[recording["id"]] = recording
-
-        offset += limit
-    # save any recordings as we are now on new rec
-    for rec in recs.values():
-        save_rec(rec, download_dir, s3_queue, args.type)
-
-    for i in range(len(processes)):
-        s3_queue.put(("DONE"))
-    for process in processes:
-        process.join()
+                    logging.info("%s saved %s", name, saved)
+            # files still to download are journaled by the archive downloader, so
+            # a resumed export can skip everything up to here
+            save_checkpoint(
+                checkpoint_file,
+                args.type,
+                start_date,
+                page_key(rec_rows),
+                shard_info,
+            )
+    queries.log_stats()
+    conn.close()
+    if metrics.count("track_data_failed") > 0:
+        logging.warning(
+            "%s saved %s tracks without data as it couldn't be fetched",
+            name,
+            metrics.count("track_data_failed"),
+        )
+    logging.info("%s finished", name)
+
+
+def shard_clause(shard_by, shard, shards, start_date, end_date):
+    """Returns the condition selecting one of shards parts of the recordings, either
+    by recording id modulo shards or by splitting start_date to end_date into equal
+    date ranges. The last date range is open ended to include newer recordings.
+    Returns the condition and its parameters"""
+    if shard_by == "id":
+        return SHARD_ID_CLAUSE, {"shards": shards, "shard": shard}
+    span = (end_date - start_date) / shards
+    clause = SHARD_FROM_CLAUSE
+    params = {"shard_from": start_date + span * shard}
+    if shard < shards - 1:
+        clause += SHARD_TO_CLAUSE
+        params["shard_to"] = start_date + span * (shard + 1)
+    return clause, params
+
+
+def shard_end_date(download_dir, args, start_date):
+    """Date shards split the recordings from start_date up to now. A resumed export
+    has to reuse the end date of the original run so its shards cover the same
+    ranges, so it is saved once for the whole run"""
+    if args.resume:
+        end_date = saved_end_date(download_dir, args.shards)
+        if end_date is not None:
+            return end_date
+        logging.info("No saved shard end date to resume with, splitting up to now")
+    # in the start dates time zone so the two can be subtracted
+    end_date = datetime.datetime.now(start_date.tzinfo)
+    run_file = download_dir / SHARD_RUN_FILE.format(shards=args.shards)
+    tmp_file = f"{run_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"end_date": end_date.isoformat()}, f)
+    os.replace(tmp_file, run_file)
+    return end_date
+
+
+def saved_end_date(download_dir, shards):
+    """Returns the end date saved for a date sharded export, falling back to the
+    checkpoint of any shard for exports started before it was saved separately"""
+    files = [SHARD_RUN_FILE.format(shards=shards)] + [
+        SHARD_CHECKPOINT_FILE.format(shard=shard, shards=shards)
+        for shard in range(shards)
+    ]
+    for filename in files:
+        if not os.path.exists(download_dir / filename):
+            continue
+        with open(download_dir / filename, "r") as f:
+            saved = json.load(f)
+        end_date = (saved.get("shard") or saved).get("end_date")
+        if end_date is not None:
+            return parse_date(end_date)
+    return None
 
 
-def save_file_process(queue):
+def query_recording_pages(
+    queries,
+    cur,
+    recordings_sql,
+    rec_type,
+    start_date,
+    limit,
+    last_key=None,
+    shard=("", {}),
+):
+    """Yields pages of rows for up to limit recordings using keyset pagination,
+    starting after last_key if given and limited to the shard condition and params.
+    The first page and following pages are each one prepared statement"""
     while True:
-        data = queue.get()
+        query_sql, params = recording_query(
+            recordings_sql, rec_type, start_date, limit, last_key, shard
+        )
+        logging.info("Querying after %s limit %s", last_key, limit)
+        rec_rows = db_retry.call(
+            queries.fetch_all, cur, "tagged_recordings", query_sql, params
+        )
+        if rec_rows is None or len(rec_rows) == 0:
+            return
+        last_key = page_key(rec_rows)
+        yield rec_rows
+
+
+def stream_recording_pages(
+    conn,
+    recordings_sql,
+    rec_type,
+    start_date,
+    limit,
+    itersize,
+    last_key=None,
+    shard=("", {}),
+):
+    """Streams rows from a server side cursor, yielding pages of rows for up to limit
+    recordings so only itersize rows and one page are held in memory at a time.
+
+    The tracks queries share the connection, and the rollback after one fails ends
+    the transaction and with it the cursor, so the stream is reopened after the last
+    page yielded"""
+    logging.info("Streaming recordings with itersize %s", itersize)
+    reopened = False
+    while True:
+        # a null limit is no limit
+        query_sql, params = recording_query(
+            recordings_sql, rec_type, start_date, None, last_key, shard
+        )
+        cur = db_retry.call(open_stream, conn, query_sql, params, itersize)
         try:
-            if data == "DONE":
-                break
-            save_rec_file(data)
-        except:
-            logging.error("Could not save rec", exc_info=True)
+            for rec_rows in cursor_pages(cur, limit):
+                last_key = page_key(rec_rows)
+                reopened = False
+                yield rec_rows
+            cur.close()
+            return
+        except psycopg2.Error:
+            # give up if the stream fails again before yielding anything
+            if reopened or conn.closed:
+                raise
+            logging.warning("Stream lost, reopening after %s", last_key, exc_info=True)
+            reopened = True
+            conn.rollback()
+
+
+def cursor_pages(cur, limit):
+    """Groups the rows of cur into pages of up to limit recordings"""
+    rec_rows = []
+    rec_ids = set()
+    for rec_row in cur:
+        # rows are ordered by recording so a new id means the last recording is complete
+        if rec_row["id"] not in rec_ids:
+            if len(rec_ids) == limit:
+                yield rec_rows
+                rec_rows = []
+                rec_ids = set()
+            rec_ids.add(rec_row["id"])
+        rec_rows.append(rec_row)
+    if len(rec_rows) > 0:
+        yield rec_rows
+
+
+def recording_query(recordings_sql, rec_type, start_date, limit, last_key, shard):
+    """Fills in the optional conditions of the recordings query, returning the sql
+    and its parameters"""
+    shard_sql, params = shard
+    params = dict(params, type=rec_type, start_date=start_date, limit=limit)
+    after = shard_sql
+    if last_key is not None:
+        after += KEYSET_CLAUSE
+        params["after_time"], params["after_id"] = last_key
+    return recordings_sql.format(after=after), params
+
+
+def page_key(rec_rows):
+    """Returns the keyset position after a page, pages are limited by recording so a
+    recordings tag rows are never split"""
+    last_row = rec_rows[-1]
+    return (last_row["recordingDateTime"].isoformat(), last_row["id"])
+
+
+def save_checkpoint(filename, rec_type, start_date, last_key, shard=None):
+    checkpoint = {
+        "type": rec_type,
+        "start_date": start_date.isoformat(),
+        "last_key": last_key,
+        "shard": shard,
+    }
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, filename)
 
 
-def save_rec_file(data):
-    filename, key = data
-    # logging.info("Downloading %s", key)
-    with open(filename, "wb") as f:
-        s3_archive_bucket.download_fileobj(key, f)
+def resume_key(filename, rec_type, start_date, shard=None):
+    """Returns the keyset position to resume an export from, or None to start from
+    the beginning if there is no checkpoint for the same export"""
+    if not os.path.exists(filename):
+        logging.info("No checkpoint to resume from in %s", filename)
+        return None
+    with open(filename, "r") as f:
+        checkpoint = json.load(f)
+    if (
+        checkpoint["type"] != rec_type
+        or parse_date(checkpoint["start_date"]) != start_date
+    ):
+        logging.error(
+            "Checkpoint is for type %s from %s not %s from %s",
+            checkpoint["type"],
+            checkpoint["start_date"],
+            rec_type,
+            start_date,
+        )
+        sys.exit(1)
+    if checkpoint.get("shard") != shard:
+        logging.error(
+            "Checkpoint is for shard %s not %s", checkpoint.get("shard"), shard
+        )
+        sys.exit(1)
+    last_key = tuple(checkpoint["last_key"])
+    logging.info("Resuming after recording %s at %s", last_key[1], last_key[0])
+    return last_key
+
+
+def open_stream(conn, sql, params, itersize):
+    """Runs sql with bound params on a new server side cursor, named cursors can only
+    execute once so each retry needs its own. Cursors can't be declared for a prepared
+    statement, but the query is only run once"""
+    cur = conn.cursor("tagged_recordings", cursor_factory=RealDictCursor)
+    cur.itersize = itersize
+    try:
+        cur.execute(sql, params)
+    except psycopg2.OperationalError:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    return cur
 
 
-def save_rec(rec, out_dir, s3_queue, file_type):
+def save_rec(rec, out_dir, archive, file_type, sidecar=False):
     dtstring = rec["recordingDateTime"].strftime("%Y%m%d-%H%M%S")
     # match old cptv-download so dont redl files
     file_base = f'{rec["id"]}-{dtstring}-{rec["deviceName"]}.txt'
@@ -211,34 +626,118 @@ def save_rec(rec, out_dir, s3_queue, file_type):
     out_file.parent.mkdir(exist_ok=True, parents=True)
     with out_file.open("w") as f:
         json.dump(rec, f, indent=4, cls=CustomJSONEncoder)
+    if sidecar:
+        save_sidecar(out_file.with_suffix(SIDECAR_EXT), rec["tracks"])
     if file_type == "thermalRaw":
         out_file = out_file.with_suffix(".cptv")
     else:
         out_file = out_file.with_suffix(".m4a")
     if out_file.exists():
         return
-    s3_queue.put((str(out_file), f'objectstore/prod/{rec["rawFileKey"]}'))
+    archive.put(
+        str(out_file), f'objectstore/prod/{rec["rawFileKey"]}', rec.get("fileHash")
+    )
+
+
+def group_recordings(rec_rows, rec_tracks):
+    """Maps joined recording and tag rows to recordings, keyed by recording id"""
+    recs = {}
+    for rec_row in rec_rows:
+        existing_rec = recs.get(rec_row["id"])
+        if existing_rec is None:
+            recording = map_recording(rec_row)
+            recording["tracks"] = rec_tracks.get(recording["id"], [])
+            recs[recording["id"]] = recording
+        elif rec_row["Tags.id"] is not None:
+            if "tags" not in existing_rec:
+                existing_rec["tags"] = []
+            tag = map_recording_tag(rec_row)
+            existing_rec["tags"].append(tag)
+    return recs
+
+
+def get_tracks_for_recordings(
+    queries, cur, tracks_sql, rec_ids, executor, s3, bucket_name, metrics
+):
+    """Fetches tracks and track tags for all rec_ids in a single query.
+    Track data for every track is requested from s3 on the executor up front,
+    tracks whose data can't be fetched are counted in metrics
+
+    Returns a dictionary of RecordingId to a list of mapped tracks
+    """
+    rec_tracks = {}
+    if len(rec_ids) == 0:
+        return rec_tracks
+    track_rows = {}
+    track_data = {}
+    params = {"rec_ids": list(rec_ids)}
+    for track_row in db_retry.call(
+        queries.fetch_all, cur, "tracks_for_recordings", tracks_sql, params
+    ):
+        track_id = track_row["id"]
+        if track_id not in track_rows:
+            track_rows[track_id] = []
+            track_data[track_id] = executor.submit(
+                get_track_data, s3, bucket_name, track_id
+            )
+        track_rows[track_id].append(track_row)
+
+    for track_id, rows in track_rows.items():
+        track_row = rows[0]
+        try:
+            data = track_data[track_id].result()
+        except Exception:
+            # one bad track shouldn't stop the export, it is saved without data
+            logging.error("Could not get data for track %s", track_id, exc_info=True)
+            metrics.inc("track_data_failed")
+            data = None
+        if data is not None:
+            track_row["data"] = data
+        mapped_track = map_track(track_row)
+        for tag_row in rows[1:]:
+            tag = map_track_tag(tag_row)
+            mapped_track["tags"].append(tag)
+        rec_tracks.setdefault(track_row["RecordingId"], []).append(mapped_track)
+    return rec_tracks
 
 
 def get_track_data(s3, bucket_name, track_id):
+    """Returns the decoded track data or None if the track has none, transient
+    errors are retried and anything else is raised"""
     try:
-        obj = s3.Object(bucket_name, f"Track/{track_id}")
-        response = obj.get()
-    except:
-        logging.error("Couldn't get track data for track %s", track_id)
+        return s3_retry.call(fetch_track_data, s3, bucket_name, track_id)
+    except s3.exceptions.NoSuchKey:
+        logging.warning("No track data for track %s", track_id)
         return None
-    # Get the StreamingBody
-    body = response["Body"]
 
-    # Decompress the gzipped data
-    # Use io.BytesIO to treat the StreamingBody as a file-like object for gzip
-    with gzip.GzipFile(fileobj=io.BytesIO(body.read())) as gz_file:
-        unzipped_data_bytes = gz_file.read()
-    data_s = json.loads(unzipped_data_bytes.decode("utf-8"))
 
+def fetch_track_data(s3, bucket_name, track_id):
+    response = s3.get_object(Bucket=bucket_name, Key=f"Track/{track_id}")
+    body = response["Body"]
+    if not trace_track_memory:
+        return decode_track_data(body)
+
+    # tracemalloc is process wide so traced decodes are run one at a time
+    with track_memory_lock:
+        tracemalloc.reset_peak()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        data_s = decode_track_data(body)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    logging.info(
+        "Decoded track %s with peak memory %s bytes",
+        track_id,
+        peak_memory - start_memory,
+    )
     return data_s
 
 
+def decode_track_data(body):
+    """Decompresses the gzipped StreamingBody straight into the json parser,
+    without first reading the compressed data into memory"""
+    with gzip.GzipFile(fileobj=body) as gz_file:
+        return json.load(gz_file)
+
+
 def map_track_tag(track_tag):
     track_tag_base = {
         "confidence": track_tag["TrackTags.confidence"],
@@ -272,42 +771,14 @@ def map_track(track):
     if track.get("maxFreqHz") is not None:
         t["maxFreqHz"] = track["maxFreqHz"]
 
-    positions = []
     if "data" in track:
         if "positions" in track["data"]:
-            for position in track["data"]["positions"]:
-                positions.append(map_position(position))
-
-            t["positions"] = positions
+            t["positions"] = Positions.from_list(track["data"]["positions"])
     track_tag = map_track_tag(track)
     t["tags"] = [track_tag]
     return t
 
 
-def map_position(position):
-    if isinstance(position, list):
-        return {
-            "x": position[1][0],
-            "y": position[1][1],
-            "width": position[1][2] - position[1][0],
-            "height": position[1][3] - position[1][1],
-            "frameTime": position[0],
-        }
-    return {
-        "x": position["x"],
-        "y": position["y"],
-        "width": position["width"],
-        "height": position["height"],
-        "order": (
-            position["frame_number"]
-            if "frame_number" in position
-            else position.get("order")
-        ),
-        "mass": position.get("mass", None),
-        "blank": position.get("blank", False),
-    }
-
-
 def map_recording(recording):
     new_rec = {
         "id": recording["id"],
@@ -401,6 +872,8 @@ class CustomJSONEncoder(json.JSONEncoder):
             return obj.isoformat()
         elif isinstance(obj, Path):
             return str(obj)
+        elif isinstance(obj, Positions):
+            return obj.to_dicts()
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
 
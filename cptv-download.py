@@ -9,10 +9,31 @@ import os
 import sys
 import random
 import logging
+import asyncio
+import hashlib
+import threading
+import functools
+from urllib.parse import urljoin
+import requests
 from dateutil.parser import parse
 
 from cacophonyapi.user import UserAPI as API
-from pool import Pool
+from cacophonyapi.apibase import APIBase
+from pool import Pool, prefetch
+from async_download import AsyncDownloader
+from sidecar import sidecar_bytes, SIDECAR_EXT
+from manifest import MANIFEST_FILE, Manifest
+from blob_store import BlobStore
+from metrics import Metrics
+from retry import RetryPolicy, api_retryable
+from resumable import (
+    CHUNK_SIZE,
+    part_file,
+    range_headers,
+    expected_size,
+    finish_part,
+    IncompleteDownloadError,
+)
 from dateutil.parser import parse
 
 SPECIAL_DIRS = ["test", "hard"]
@@ -20,6 +41,16 @@ SPECIAL_DIRS = ["test", "hard"]
 # anything before this is tracker version 9
 OLD_TRACKER = parse("2021-06-01 17:02:30.592 +1200")
 
+# bounds for the adaptive query date window
+MIN_WINDOW = datetime.timedelta(hours=1)
+MAX_WINDOW = datetime.timedelta(days=180)
+
+# incremental syncs re-fetch anything updated this long before the last sync started
+# so clock differences between here and the server can't cause missed updates
+CHECKPOINT_MARGIN = datetime.timedelta(hours=1)
+# query rows start from here when no start date is given
+FIRST_DATE = datetime.datetime(2017, 1, 1)
+
 
 def init_logging(timestamps=True):
     """Set up logging for use by various classifier pipeline scripts.
@@ -52,6 +83,9 @@ class CPTVDownloader:
         self.only_tags = None
 
         self.auto_delete = False
+        # only process recordings new or changed since the last incremental sync of a
+        # server with the same query options
+        self.incremental = False
         self.verbose = False
 
         self.user = None
@@ -59,28 +93,52 @@ class CPTVDownloader:
         self.out_folder = None
 
         self.workers = 4
+        # retries, backoff and circuit breaker shared by all download requests, a
+        # recording isn't retried as a whole as each of its requests already is
+        self.api_retry = RetryPolicy("API", api_retryable)
+        # queries have their own so failing downloads can't open their circuit
+        self.query_retry = RetryPolicy("API query", api_retryable)
+        # "threads" uses a pool of worker threads, "async" uses AsyncDownloader
+        self.engine = "threads"
+        # maximum number of concurrent recordings for the async engine
+        self.max_requests = 100
+        # maximum recordings waiting for a worker before querying blocks
+        self.queue_depth = 200
+        # number of query pages fetched ahead of the workers
+        self.prefetch_pages = 1
+        # number of recordings each query date window should aim to return
+        self.window_target = 400
         self.overwrite_meta = True
         self.include_metadata = True
         self.include_mp4 = False
-
-        # dictionary mapping filename to paths of all files in output folder
-        self.file_list = {}
-
-        self.ignored = 0
-        self.not_selected = 0
-        self.processed = 0
+        self.include_sidecar = False
+
+        # index of all files in the output folder
+        self.manifest = None
+        # optional BlobStore shared between output folders and servers
+        self.blob_store = None
+        # per thread state such as each workers requests session
+        self._local = threading.local()
+
+        # counters and request latencies shared by all workers
+        self.metrics = Metrics()
+        # seconds between progress reports
+        self.metrics_interval = 60
+        # optional Prometheus text file rewritten with every progress report
+        self.prometheus_file = None
 
     def process(self, url):
         """Downloads all requested files from specified server"""
-        self.ignored = 0
-        self.not_selected = 0
-        self.processed = 0
+        self.metrics = Metrics()
+        sync_started = datetime.datetime.now(datetime.timezone.utc)
 
         api = API(url, self.user, self.password)
+        self.open_manifest()
 
         if self.recording_id:
             recording = api.get(self.recording_id)
-            self._download(recording, api, Path(self.out_folder))
+            if self._prefilter([recording]):
+                self._download(recording, api, Path(self.out_folder))
             return
         print("Querying server {0}".format(url))
         print("Limit is {0}".format(self.limit))
@@ -89,18 +147,132 @@ class CPTVDownloader:
         print("Required tags are {0}".format(self.only_tags))
         print("Ignore tags are {0}".format(self.ignore_tags))
 
-        pool = Pool(self.workers, self._downloader, api, Path(self.out_folder))
-        offset = 0
-        if len(self.only_tags) == 0:
+        if not self.only_tags:
             self.only_tags = None
-        remaining = self.limit
         if self.start_date is None:
-            self.start_date = datetime.datetime(2017, 1, 1)
+            self.start_date = FIRST_DATE
+        checkpoint = None
+        if self.incremental:
+            checkpoint = self._load_checkpoint(url)
+        self._checkpoint = {
+            "startDate": self.start_date.isoformat(),
+            "recordingDateTime": None,
+            "recordingId": None,
+            "updatedAt": (sync_started - CHECKPOINT_MARGIN).isoformat(),
+        }
+        pages = self._query_pages(api, checkpoint)
+
+        out_base = Path(self.out_folder)
+        self.metrics.start(self.metrics_interval, self.prometheus_file)
+        try:
+            if self.engine == "async":
+                async_downloader = AsyncDownloader(
+                    self, api, out_base, self.max_requests
+                )
+                asyncio.run(async_downloader.run(pages))
+            else:
+                self._process_pool(pages, api, out_base)
+        finally:
+            self.metrics.stop(self.prometheus_file)
+
+        if self.incremental:
+            self._save_checkpoint(url)
+
+    def _process_pool(self, pages, api, out_base):
+        # a failed query or Ctrl-C cancels the queued downloads
+        with Pool(self.workers, max_queued=self.queue_depth) as pool:
+            self.metrics.set_gauge("queue_depth", pool.qsize)
+            # the next page is queried while the workers download the current one
+            for rows in prefetch(pages, self.prefetch_pages):
+                for row in rows:
+                    future = pool.submit(self._download, row, api, out_base)
+                    future.add_done_callback(functools.partial(self._downloaded, row))
+                logging.info("Added %s recordings to pool", len(rows))
+
+    def _checkpoint_query(self):
+        """The options deciding which recordings and files a sync covers, a
+        checkpoint is only reused by a sync with the same options. The date range
+        is checked separately"""
+        return json.dumps(
+            {
+                "type": self.type,
+                "tags": sorted(self.only_tags) if self.only_tags else None,
+                "tagMode": self.tag_mode,
+                "ignoreTags": sorted(self.ignore_tags),
+                "recordingTags": bool(self.recording_tags),
+                "onlyMetadata": self.only_metadata,
+                "metadata": self.include_metadata,
+                "mp4": self.include_mp4,
+                "sidecar": self.include_sidecar,
+            },
+            sort_keys=True,
+        )
+
+    def _load_checkpoint(self, url):
+        """Returns the checkpoint of the last sync of url with the same options, or
+        None if a full sync is needed"""
+        checkpoint = self.manifest.get_checkpoint(url, self._checkpoint_query())
+        if checkpoint is None:
+            logging.info("No checkpoint for %s with these options, full sync", url)
+            return None
+        try:
+            covered = parse(checkpoint["startDate"]) <= self.start_date
+        except TypeError:
+            # naive and timezone aware dates can't be compared
+            covered = False
+        if not covered:
+            logging.info(
+                "Checkpoint for %s starts at %s after %s, full sync",
+                url,
+                checkpoint["startDate"],
+                self.start_date,
+            )
+            return None
+        logging.info("Syncing changes since checkpoint %s", checkpoint)
+        return checkpoint
+
+    def _save_checkpoint(self, url):
+        if self.limit is not None:
+            logging.info("Not saving checkpoint as sync was limited")
+        elif self.metrics.count("failed") > 0:
+            logging.warning(
+                "Not saving checkpoint as %s recordings failed to download",
+                self.metrics.count("failed"),
+            )
+        else:
+            logging.info("Saving checkpoint %s", self._checkpoint)
+            self.manifest.set_checkpoint(
+                url, self._checkpoint_query(), self._checkpoint
+            )
+
+    def _update_checkpoint(self, rows):
+        """Keeps the newest recording seen this sync, recordingDateTime is compared
+        as the api's ISO 8601 UTC strings"""
+        checkpoint = self._checkpoint
+        for row in rows:
+            rec_time = row.get("recordingDateTime")
+            if rec_time is None:
+                continue
+            if checkpoint["recordingDateTime"] is None or (rec_time, row["id"]) > (
+                checkpoint["recordingDateTime"],
+                checkpoint["recordingId"],
+            ):
+                checkpoint["recordingDateTime"] = rec_time
+                checkpoint["recordingId"] = row["id"]
+
+    def _query_pages(self, api, checkpoint=None):
+        """Queries the server in date windows, yielding each page of recordings.
+        If checkpoint is set only recordings new or changed since it are returned"""
+        offset = 0
+        remaining = self.limit
         end_date = self.end_date
         if self.end_date is None:
             end_date = datetime.datetime.now()
+        first_date = self.start_date
+        window = datetime.timedelta(days=2)
         while self.start_date < end_date:
-            self.end_date = self.start_date + datetime.timedelta(days=2)
+            self.end_date = min(self.start_date + window, end_date)
+            window_rows = 0
             logging.info(
                 "running %s-%s with limit %s",
                 self.start_date,
@@ -108,78 +280,105 @@ class CPTVDownloader:
                 self.limit,
             )
             while self.limit is None or offset < self.limit:
-                rows = None
-                for i in range(3):
-                    try:
-                        rows = api.query(
-                            limit=remaining,
-                            startDate=self.start_date,
-                            endDate=self.end_date,
-                            tagmode=self.tag_mode,
-                            tags=self.only_tags,
-                            offset=offset,
-                            type_=self.type,
-                        )
-                        break
-                    except:
-                        logging.error(
-                            "Could not get query failed %s times", i, exc_info=True
-                        )
-                        if i < 3:
-                            time.sleep(10)
-                if rows is None:
-                    logging.error("Query failed stopping")
-                    pool.stop()
-                    raise Exception("API Query failed")
+                query_start = time.time()
+                with self.metrics.time("query"):
+                    rows = self.query_retry.call(
+                        api.query,
+                        limit=remaining,
+                        startDate=self.start_date,
+                        endDate=self.end_date,
+                        tagmode=self.tag_mode,
+                        tags=self.only_tags,
+                        offset=offset,
+                        type_=self.type,
+                    )
+                logging.info(
+                    "Query %s-%s offset %s returned %s rows in %.2fs",
+                    self.start_date,
+                    self.end_date,
+                    offset,
+                    len(rows),
+                    time.time() - query_start,
+                )
 
                 if len(rows) == 0:
                     break
                 offset += len(rows)
+                window_rows += len(rows)
                 if remaining:
                     remaining -= len(rows)
 
-                if self.auto_delete:
-                    self.update_file_locations()
-
-                for row in rows:
-                    pool.put(row)
-                logging.info("Added %s recordings to pool", len(rows))
-                pool.wait()
+                self._update_checkpoint(rows)
+                # tags from the query row are enough to filter, so skipped recordings
+                # never reach the workers or request their tracks
+                rows = self._prefilter(rows, checkpoint)
+                if len(rows) > 0:
+                    yield rows
             self.start_date = self.end_date
             offset = 0
+            # fraction of the date range queried, used to estimate time remaining
+            self.metrics.set_gauge(
+                "progress", (self.start_date - first_date) / (end_date - first_date)
+            )
             if self.limit and remaining <= 0:
                 break
-        pool.stop()
-
-    def update_file_locations(self):
-        """Scans output folder building a list of all files."""
-        self.file_list = {}
-
-        for root, _, files in os.walk(self.out_folder):
-            for file in files:
-                if file not in self.file_list:
-                    self.file_list[file] = []
-                self.file_list[file].append(root)
-
-    def _downloader(self, q, api, out_base):
-        """Worker to handle downloading of files."""
-        while True:
-            r = q.get()
-            if r is None:
-                logging.info(
-                    "Worker processed %s and skipped %s files",
-                    self.processed,
-                    self.ignored + self.not_selected,
-                )
-                break
+            window = self._next_window(window, window_rows)
 
-            try:
-                downloaded = self._download(r, api, out_base)
-                self.processed += 1
-            except:
-                logging.error("Error downloading rec %s", r["id"], exc_info=True)
-            finally:
-                q.task_done()
+    def _next_window(self, window, rows):
+        """Scales the query date window towards returning window_target rows,
+        growing at most 2x at a time so empty years are skipped quickly"""
+        if rows == 0:
+            scale = 2
+        else:
+            scale = min(2, self.window_target / rows)
+        return min(max(window * scale, MIN_WINDOW), MAX_WINDOW)
+
+    def open_manifest(self):
+        """Opens the output folder manifest. Indexing the existing files of a new
+        manifest walks the whole folder, so it is only built when auto delete or
+        incremental syncs need it, but once built it is always kept up to date"""
+        if self.manifest is not None:
+            return
+        needed = self.auto_delete or self.incremental
+        if not needed and not (Path(self.out_folder) / MANIFEST_FILE).exists():
+            return
+        os.makedirs(self.out_folder, exist_ok=True)
+        self.manifest = Manifest(self.out_folder)
+        if self.manifest.is_new:
+            logging.info("Building manifest of %s", self.out_folder)
+            self.manifest.reconcile()
+
+    def _add_to_manifest(self, path, file_hash=None):
+        if self.manifest is not None:
+            self.manifest.add(path, file_hash)
+
+    def _link_from_store(self, r, out_file):
+        """Links out_file to the recordings blob if it is already in the blob store"""
+        file_hash = r.get("fileHash")
+        if self.blob_store is None or file_hash is None:
+            return False
+        if not self.blob_store.link(file_hash, out_file):
+            return False
+        logging.info("Linked %s from blob store", out_file)
+        self._add_to_manifest(out_file, file_hash)
+        return True
+
+    def _add_to_store(self, r, out_file):
+        # downloads are already checked against fileHash
+        if self.blob_store is not None and r.get("fileHash") is not None:
+            self.blob_store.add(r["fileHash"], out_file)
+
+    def _downloaded(self, r, future):
+        """Counts a finished download task"""
+        if future.cancelled():
+            self.metrics.inc("cancelled")
+        elif future.exception() is not None:
+            logging.error(
+                "Error downloading rec %s", r["id"], exc_info=future.exception()
+            )
+            self.metrics.inc("failed")
+        else:
+            self.metrics.inc("processed")
 
     def _get_manual_tags(self, r):
         if self.recording_tags:
@@ -198,7 +397,9 @@ class CPTVDownloader:
 
         return tags, description, out_dir
 
-    def _download(self, r, api, out_base):
+    def _prepare(self, r):
+        """Works out the file base name, raw file extension and tracker version of a
+        recording, returns None if the recording can't be downloaded"""
         dtstring = ""
         rawMime = r.get("rawMimeType", "application/x-cptv")
         if rawMime == "application/x-cptv":
@@ -213,7 +414,7 @@ class CPTVDownloader:
             extension = ".mp4"
         else:
             logging.info("Unknown mime type %s for %s", rawMime, r.get("id"))
-            return
+            return None
         tracker_version = 10
         if "recordingDateTime" in r:
             try:
@@ -226,51 +427,168 @@ class CPTVDownloader:
                 tracker_version = 9
 
         file_base = str(r["id"]) + "-" + dtstring + "-" + r["deviceName"]
-        r["Tracks"] = api.get_tracks(r["id"]).get("tracks")
+        return file_base, extension, tracker_version
+
+    def _skip_reason(self, r):
+        """Works out from the query row alone whether a recording should be skipped,
+        returning the reason or None if it should be downloaded"""
+        prepared = self._prepare(r)
+        if prepared is None:
+            return "unknown mime type"
+        file_base = prepared[0]
         tags, tags_desc, out_dir = self._get_tags_descriptor_and_out_dir(r, file_base)
         if out_dir is None:
             logging.info('No valid out directory for file "%s"', file_base)
-            return
+            return "no out directory"
 
-        out_dir = out_base / out_dir
         if tags_desc in self.ignore_tags:
             logging.info('Ignored file "%s" - tag "%s" ignored', file_base, tags_desc)
-            self.ignored += 1
-            return
+            return "ignored tag"
 
         if self.only_tags and not any([tag for tag in self.only_tags if tag in tags]):
             logging.info(f'Ignored file "{file_base}" - no matching tags for "{tags}')
-            self.not_selected += 1
-            return
-        fullpath = out_dir / file_base
+            return "not selected"
+        return None
+
+    def _prefilter(self, rows, checkpoint=None):
+        """Drops recordings that would be skipped before they reach the download
+        workers, counting them by reason. With a checkpoint recordings that haven't
+        changed since it are skipped too"""
+        selected = []
+        for r in rows:
+            reason = self._skip_reason(r)
+            if reason is None and checkpoint is not None:
+                if not changed_since(r, checkpoint):
+                    reason = "unchanged"
+            if reason is None:
+                selected.append(r)
+            else:
+                self.metrics.inc("skipped", label=reason)
+        return selected
+
+    def _make_out_dir(self, r, file_base, out_base):
+        """Creates the directory to save a selected recording in"""
+        _, _, out_dir = self._get_tags_descriptor_and_out_dir(r, file_base)
+        out_dir = out_base / out_dir
         if self.auto_delete:
-            self._delete_existing(file_base.with_suffix(extension), out_dir)
+            self._delete_existing(file_base, out_dir)
 
         os.makedirs(out_dir, exist_ok=True)
+        return out_dir
+
+    def _save_metadata(self, r, fullpath, server, tracker_version):
+        if not self.include_metadata:
+            return
+        meta_file = fullpath.with_suffix(".txt")
+        r["server"] = server
+        r["tracker_version"] = tracker_version
+        r["additionalMetadata"] = ""
+        if self.overwrite_meta or not os.path.exists(meta_file):
+            self._write_if_changed(meta_file, json.dumps(r, indent=4).encode("utf-8"))
+        if self.include_sidecar and r.get("Tracks") is not None:
+            self._write_if_changed(
+                fullpath.with_suffix(SIDECAR_EXT), sidecar_bytes(r["Tracks"])
+            )
+
+    def _write_if_changed(self, filename, data):
+        """Atomically writes data to filename unless the file already holds it, so
+        unchanged files keep their mtime"""
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self._existing_hash(filename):
+            logging.debug("Unchanged %s", filename)
+            return
+        write_atomic(filename, data)
+        self._add_to_manifest(filename, digest)
+
+    def _needs_tracks(self, fullpath):
+        """Tracks are only used in the metadata, so aren't needed if it won't be written"""
+        if not self.include_metadata:
+            return False
+        return (
+            self.include_sidecar
+            or self.overwrite_meta
+            or not fullpath.with_suffix(".txt").exists()
+        )
+
+    def _session(self):
+        """Returns this threads requests session, reusing its keep-alive connections
+        where UserAPI opens a new connection for every request"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _get_tracks(self, api, recording_id):
+        url = urljoin(api._baseurl, f"/api/v1/recordings/{recording_id}/tracks")
+        with self.metrics.time("tracks"):
+            return self.api_retry.call(self._get_json, api, url).get("tracks")
+
+    def _get_json(self, api, url):
+        r = self._session().get(url, headers=api._auth_header, timeout=APIBase.TIMEOUT)
+        return api._check_response(r)
+
+    def _existing_hash(self, filename):
+        """Returns the sha1 of an existing file, from the manifest if it is known"""
+        if self.manifest is not None:
+            file_hash = self.manifest.file_hash(filename)
+            if file_hash is not None:
+                return file_hash
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _download(self, r, api, out_base):
+        prepared = self._prepare(r)
+        if prepared is None:
+            return
+        file_base, extension, tracker_version = prepared
+        out_dir = self._make_out_dir(r, file_base, out_base)
+        fullpath = out_dir / file_base
+        if self._needs_tracks(fullpath):
+            r["Tracks"] = self._get_tracks(api, r["id"])
         if not self.only_metadata:
             out_file = fullpath.with_suffix(extension)
-            if not out_file.exists():
+            if not out_file.exists() and not self._link_from_store(r, out_file):
                 logging.info("Downloading %s", file_base)
-                if iter_to_file(out_file, api.download_raw(r["id"])):
+                with self.metrics.time("raw"):
+                    downloaded = iter_to_file(
+                        out_file,
+                        api,
+                        r["id"],
+                        "downloadRawJWT",
+                        r.get("fileHash"),
+                        retry=self.api_retry,
+                        session=self._session(),
+                    )
+                if downloaded:
+                    self.metrics.inc("bytes", out_file.stat().st_size)
                     logging.info("%s.%s [%s]", format_row(r), extension, out_dir)
+                    self._add_to_manifest(out_file, r.get("fileHash"))
+                    self._add_to_store(r, out_file)
 
         if self.include_mp4:
             out_file = fullpath.with_suffix(".mp4")
             if not out_file.exists():
-                if iter_to_file(out_file, api.download(r["id"])):
+                with self.metrics.time("mp4"):
+                    downloaded = iter_to_file(
+                        out_file,
+                        api,
+                        r["id"],
+                        "downloadFileJWT",
+                        retry=self.api_retry,
+                        session=self._session(),
+                    )
+                if downloaded:
+                    self.metrics.inc("bytes", out_file.stat().st_size)
                     logging.info("%s.mp4 [%s]", format_row(r), out_dir)
+                    self._add_to_manifest(out_file)
 
-        if self.include_metadata:
-            meta_file = fullpath.with_suffix(".txt")
-            r["server"] = api._baseurl
-            r["tracker_version"] = tracker_version
-            r["additionalMetadata"] = ""
-            if self.overwrite_meta or not os.path.exists(meta_file):
-                json.dump(r, open(meta_file, "w"), indent=4)
+        self._save_metadata(r, fullpath, api._baseurl, tracker_version)
 
     def _delete_existing(self, file_base, new_dir):
-        for path in self.file_list.get(file_base, []):
-            path = Path(path)
+        for path in self.manifest.locations(file_base):
             if str(path) != str(new_dir) and path.name not in SPECIAL_DIRS:
                 logging.info(
                     "Found %s in '%s' but should be in '%s'",
@@ -278,8 +596,36 @@ class CPTVDownloader:
                     str(path),
                     str(new_dir),
                 )
-                for ext in ["cptv", "dat", "mp4"]:
-                    remove_file(str(path / (file_base + "." + ext)))
+                # the metadata and sidecar are written again in the new folder
+                for ext in [".cptv", ".dat", ".mp4", ".txt", SIDECAR_EXT]:
+                    remove_file(str(path / (file_base + ext)))
+                    self.manifest.remove(path / (file_base + ext))
+
+
+def changed_since(r, checkpoint):
+    """Whether a query row is a recording newer than the checkpoint or updated since
+    it. Adding or changing a tag writes only the tag's row, not the recording's
+    updatedAt, so the times of the recording and track tags are checked as well and
+    a tag without a time is taken as changed"""
+    rec_time = r.get("recordingDateTime")
+    if (
+        rec_time is None
+        or checkpoint["recordingDateTime"] is None
+        or (rec_time, r["id"])
+        > (checkpoint["recordingDateTime"], checkpoint["recordingId"])
+    ):
+        return True
+    since = parse(checkpoint["updatedAt"])
+    if r.get("updatedAt") is None or parse(r["updatedAt"]) > since:
+        return True
+    tags = list(r.get("Tags", []))
+    for track in r.get("tracks", []):
+        tags.extend(track.get("tags", []))
+    for tag in tags:
+        tag_time = tag.get("updatedAt", tag.get("createdAt"))
+        if tag_time is None or parse(tag_time) > since:
+            return True
+    return False
 
 
 def remove_file(file):
@@ -350,15 +696,66 @@ def format_row(row):
     return "{} {} {}s".format(row["id"], row["deviceName"], row.get("duration"))
 
 
-def iter_to_file(filename, source, overwrite=False):
+def write_atomic(filename, data):
+    """Writes data to a temporary file then renames it over filename, so readers
+    never see a partially written file"""
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+    os.replace(tmp_file, filename)
+
+
+def iter_to_file(
+    filename,
+    api,
+    recording_id,
+    jwt_key,
+    file_hash=None,
+    overwrite=False,
+    retry=None,
+    session=requests,
+):
+    """Downloads a recording file through a signed url into a .part file, resuming
+    after an interruption with an HTTP Range request. The file is only renamed into
+    place once its size and file_hash match"""
     if not overwrite and Path(filename).is_file():
         return False
-    with open(filename, "wb") as f:
-        for chunk in source:
-            f.write(chunk)
+    if retry is None:
+        retry = RetryPolicy("Download", api_retryable, attempts=3)
+    retry.call(download_part, filename, api, recording_id, jwt_key, file_hash, session)
     return True
 
 
+def download_part(filename, api, recording_id, jwt_key, file_hash, session):
+    """Makes one attempt at downloading filename, continuing any existing part file"""
+    part = part_file(filename)
+    url = urljoin(api._baseurl, f"/api/v1/recordings/{recording_id}")
+    r = session.get(url, headers=api._auth_header, timeout=APIBase.TIMEOUT)
+    token = api._check_response(r)[jwt_key]
+
+    offset, headers = range_headers(part)
+    with session.get(
+        urljoin(api._baseurl, "/api/v1/signedUrl"),
+        params={"jwt": token},
+        headers=headers,
+        stream=True,
+        timeout=APIBase.DOWNLOAD_TIMEOUT,
+    ) as response:
+        if response.status_code == 416:
+            part.unlink()
+            raise IncompleteDownloadError(
+                f"{part} is no longer valid for this recording, restarting"
+            )
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        size = expected_size(response.headers, offset)
+        with open(part, "ab" if offset > 0 else "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    finish_part(part, filename, size, file_hash)
+
+
 def main():
     args = parse_args()
     init_logging()
@@ -393,6 +790,17 @@ def main():
     downloader.verbose = args.verbose
     downloader.auto_delete = args.auto_delete
     downloader.include_mp4 = args.include_mp4
+    downloader.include_sidecar = args.sidecar
+    downloader.engine = args.engine
+    downloader.max_requests = args.max_requests
+    downloader.queue_depth = args.queue_depth
+    downloader.api_retry.attempts = args.retries + 1
+    downloader.window_target = args.window_target
+    downloader.incremental = args.incremental
+    downloader.metrics_interval = args.metrics_interval
+    downloader.prometheus_file = args.prometheus_file
+    if args.blob_store:
+        downloader.blob_store = BlobStore(args.blob_store)
     downloader.tag_mode = args.tag_mode
 
     if downloader.auto_delete:
@@ -509,6 +917,63 @@ def parse_args():
         default=False,
         help="Only download metadata",
     )
+    parser.add_argument(
+        "--sidecar",
+        action="store_true",
+        default=False,
+        help="Also save track positions as typed arrays in a .npz file next to the metadata",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "async"],
+        default="threads",
+        help="Download with a pool of worker threads or with asyncio",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=100,
+        help="Maximum number of recordings downloading at once with the async engine",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=200,
+        help="Maximum recordings queued for the download workers before querying waits",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Times a failed api request is retried, with exponential backoff",
+    )
+    parser.add_argument(
+        "--window-target",
+        type=int,
+        default=400,
+        help="Number of recordings each query date window is sized to return",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Only process recordings new or changed since the last incremental sync "
+        "of each server with the same options",
+    )
+    parser.add_argument(
+        "--blob-store",
+        help="Folder of recordings stored by fileHash, downloads are hardlinked from here",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="Seconds between progress reports of counts, throughput, latency and ETA",
+    )
+    parser.add_argument(
+        "--prometheus-file",
+        help="Also write progress metrics to this file in the Prometheus text format",
+    )
     args = parser.parse_args()
     if args.ignore is None:
         args.ignore = [
@@ -0,0 +1,181 @@
+"""
+A persistent index of the files in a download folder, so existing files can be
+found without walking the whole folder.
+
+Reconcile an existing folder with:
+    python manifest.py <out_folder>
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+from resumable import PART_EXT
+
+MANIFEST_FILE = ".manifest.sqlite"
+CHECKPOINT_FIELDS = ("startDate", "recordingDateTime", "recordingId", "updatedAt")
+
+
+class Manifest:
+    """
+    SQLite index of files under root keyed by file base name (the file name
+    without its extension), recording folder, extension, size and hash
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        db_file = self.root / MANIFEST_FILE
+        self.is_new = not db_file.exists()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_file), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "name TEXT NOT NULL, ext TEXT NOT NULL, folder TEXT NOT NULL,"
+                "size INTEGER, hash TEXT, PRIMARY KEY (name, ext, folder))"
+            )
+            # incremental sync checkpoints by server and query options
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_checkpoints ("
+                "server TEXT NOT NULL, query TEXT NOT NULL, startDate TEXT,"
+                "recordingDateTime TEXT, recordingId INTEGER, updatedAt TEXT,"
+                "PRIMARY KEY (server, query))"
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, path, file_hash=None):
+        """Records a file that has been written under root"""
+        path = Path(path)
+        folder, name, ext = self._key(path)
+        size = path.stat().st_size
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (name, ext, folder, size, hash) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (name, ext, folder, size, file_hash),
+            )
+
+    def remove(self, path):
+        folder, name, ext = self._key(Path(path))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM files WHERE name = ? AND ext = ? AND folder = ?",
+                (name, ext, folder),
+            )
+
+    def file_hash(self, path):
+        """Returns the recorded hash of path if its size still matches the manifest"""
+        path = Path(path)
+        folder, name, ext = self._key(path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, hash FROM files WHERE name = ? AND ext = ? AND folder = ?",
+                (name, ext, folder),
+            ).fetchone()
+        if row is None or row[1] is None:
+            return None
+        size, file_hash = row
+        try:
+            if path.stat().st_size != size:
+                return None
+        except FileNotFoundError:
+            return None
+        return file_hash
+
+    def locations(self, file_base):
+        """Returns the folders containing any file with this base name"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT folder FROM files WHERE name = ?", (file_base,)
+            ).fetchall()
+        return [self.root / folder for folder, in rows]
+
+    def get_checkpoint(self, server, query):
+        """Returns the last incremental sync checkpoint for server with the same
+        query options or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT startDate, recordingDateTime, recordingId, updatedAt "
+                "FROM sync_checkpoints WHERE server = ? AND query = ?",
+                (server, query),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(CHECKPOINT_FIELDS, row))
+
+    def set_checkpoint(self, server, query, checkpoint):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_checkpoints (server, query, startDate, "
+                "recordingDateTime, recordingId, updatedAt) VALUES (?, ?, ?, ?, ?, ?)",
+                (server, query) + tuple(checkpoint[f] for f in CHECKPOINT_FIELDS),
+            )
+
+    def reconcile(self):
+        """Walks root, adding new files, updating files whose size changed and
+        removing entries for files that no longer exist"""
+        with self._lock:
+            known = {
+                (folder, name, ext): size
+                for name, ext, folder, size in self._conn.execute(
+                    "SELECT name, ext, folder, size FROM files"
+                )
+            }
+        seen = set()
+        changed = []
+        for folder, _, files in os.walk(self.root):
+            for file in files:
+                if file.startswith(MANIFEST_FILE) or file.endswith(PART_EXT):
+                    continue
+                path = Path(folder) / file
+                key = self._key(path)
+                seen.add(key)
+                size = path.stat().st_size
+                if known.get(key) != size:
+                    changed.append(key + (size,))
+        removed = known.keys() - seen
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (folder, name, ext, size) "
+                "VALUES (?, ?, ?, ?)",
+                changed,
+            )
+            self._conn.executemany(
+                "DELETE FROM files WHERE folder = ? AND name = ? AND ext = ?",
+                removed,
+            )
+        logging.info(
+            "Reconciled manifest %s changed and %s removed files",
+            len(changed),
+            len(removed),
+        )
+
+    def _key(self, path):
+        folder = os.path.relpath(path.parent, self.root)
+        return folder, path.stem, path.suffix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reconcile the manifest of a download folder with its files"
+    )
+    parser.add_argument("out_folder", help="Root folder files are downloaded to")
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.INFO, format="%(levelname)7s %(message)s"
+    )
+    manifest = Manifest(args.out_folder)
+    manifest.reconcile()
+    manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PROMETHEUS_PREFIX = "cptv_download"
+
+
+class Metrics:
+    """
+    Thread safe counters, gauges and request latency histograms for a download run.
+    Reported periodically as a log line and optionally as a Prometheus text file
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        # name -> [bucket counts..., count above last bucket], sum of seconds
+        self._latencies = {}
+        # name -> value or a function returning the value
+        self._gauges = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_report = None
+        self.started = time.time()
+
+    def inc(self, name, value=1, label=None):
+        with self._lock:
+            self._counters[(name, label)] += value
+
+    def count(self, name, label=None):
+        with self._lock:
+            return self._counters[(name, label)]
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self._latencies:
+                self._latencies[name] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            buckets, _ = self._latencies[name]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(LATENCY_BUCKETS)
+            buckets[i] += 1
+            self._latencies[name][1] += seconds
+
+    @contextmanager
+    def time(self, name):
+        """Records the latency of the enclosed request under name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def start(self, interval, prometheus_file=None):
+        """Reports every interval seconds on a background thread until stop"""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._report_loop, args=(interval, prometheus_file), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, prometheus_file=None):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.report(prometheus_file)
+
+    def _report_loop(self, interval, prometheus_file):
+        while not self._stop.wait(interval):
+            try:
+                self.report(prometheus_file)
+            except:
+                logging.error("Could not report metrics", exc_info=True)
+
+    def _snapshot(self):
+        with self._lock:
+            counters = Counter(self._counters)
+            latencies = {
+                name: (list(buckets), total)
+                for name, (buckets, total) in self._latencies.items()
+            }
+            gauges = dict(self._gauges)
+        gauges = {
+            name: value() if callable(value) else value
+            for name, value in gauges.items()
+        }
+        return counters, latencies, gauges
+
+    def report(self, prometheus_file=None):
+        counters, latencies, gauges = self._snapshot()
+        now = time.time()
+        elapsed = now - self.started
+        downloaded = counters[("bytes", None)]
+        rate = downloaded / elapsed if elapsed > 0 else 0
+        if self._last_report is not None:
+            last_time, last_bytes = self._last_report
+            if now > last_time:
+                rate = (downloaded - last_bytes) / (now - last_time)
+        self._last_report = (now, downloaded)
+
+        skipped = skipped_summary(counters)
+        eta = "-"
+        progress = gauges.get("progress")
+        if progress:
+            eta = datetime.timedelta(seconds=int(elapsed * (1 - progress) / progress))
+        latency = " ".join(
+            f"{name} {total / max(sum(buckets), 1):.2f}s"
+            for name, (buckets, total) in sorted(latencies.items())
+        )
+        logging.info(
+            "Processed %s failed %s skipped %s queued %s %.2f MB/s eta %s mean latency %s",
+            counters[("processed", None)],
+            counters[("failed", None)],
+            skipped,
+            gauges.get("queue_depth", "-"),
+            rate / 1e6,
+            eta,
+            latency or "-",
+        )
+        if prometheus_file is not None:
+            self.write_prometheus(prometheus_file, counters, latencies, gauges)
+
+    def write_prometheus(self, filename, counters, latencies, gauges):
+        """Writes the metrics in the Prometheus text format, renaming into place so
+        a textfile collector never reads a partial file"""
+        lines = []
+        for (name, label), value in sorted(
+            counters.items(), key=lambda item: (item[0][0], item[0][1] or "")
+        ):
+            labels = "" if label is None else f'{{reason="{label}"}}'
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}_total{labels} {value}")
+        for name, value in sorted(gauges.items()):
+            if value is not None:
+                lines.append(f"{PROMETHEUS_PREFIX}_{name} {value}")
+        metric = f"{PROMETHEUS_PREFIX}_request_seconds"
+        for name, (buckets, total) in sorted(latencies.items()):
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(
+                    f'{metric}_bucket{{request="{name}",le="{bound}"}} {cumulative}'
+                )
+            cumulative += buckets[-1]
+            lines.append(f'{metric}_bucket{{request="{name}",le="+Inf"}} {cumulative}')
+            lines.append(f'{metric}_sum{{request="{name}"}} {total}')
+            lines.append(f'{metric}_count{{request="{name}"}} {cumulative}')
+
+        tmp_file = f"{filename}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, filename)
+
+
+def skipped_summary(counters):
+    """The total skipped count followed by the count for each reason"""
+    reasons = sorted(
+        (str(label), value)
+        for (name, label), value in counters.items()
+        if name == "skipped" and value > 0
+    )
+    summary = str(sum(value for _, value in reasons))
+    if reasons:
+        summary += " (" + ", ".join(f"{r} {value}" for r, value in reasons) + ")"
+    return summary
@@ -1,32 +1,152 @@
 import queue
 import threading
 import logging
+from concurrent.futures import Future, CancelledError
 
 
 class Pool:
     """
-    Simple worker thread pool
+    Bounded worker thread pool returning futures. submit blocks once max_queued
+    tasks are waiting so producers can't run ahead of the workers. Failed tasks are
+    retried up to retries times, waiting backoff seconds doubling each attempt, if
+    retryable is given only errors it returns True for are retried.
+    Used as a context manager pending tasks are cancelled if the with block raises,
+    including on KeyboardInterrupt
     """
 
-    def __init__(self, num_workers, run, *args):
-        self._q = queue.Queue()
-        args = (self._q,) + args
+    def __init__(self, num_workers, max_queued=0, retries=0, backoff=1, retryable=None):
+        # put blocks once max_queued items are waiting, 0 means unbounded
+        self._q = queue.Queue(maxsize=max_queued)
+        self.retries = retries
+        self.backoff = backoff
+        self.retryable = retryable
+        self._cancelled = threading.Event()
         self._threads = []
         for _ in range(num_workers):
-            t = threading.Thread(target=run, args=args)
+            t = threading.Thread(target=self._worker, daemon=True)
             t.start()
             self._threads.append(t)
 
-    def put(self, item):
-        self._q.put(item)
+    def __enter__(self):
+        return self
 
-    def stop(self):
-        self.wait()
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            logging.info("Cancelling %s queued tasks", self._q.qsize())
+            self.cancel()
+        self.shutdown()
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs), blocking while the queue is full, and returns
+        a Future of its result"""
+        future = Future()
+        item = (future, fn, args, kwargs)
+        while True:
+            if self._cancelled.is_set():
+                raise CancelledError()
+            try:
+                # time out so a cancel can't leave the producer blocked forever
+                self._q.put(item, timeout=1)
+                return future
+            except queue.Full:
+                pass
+
+    def qsize(self):
+        return self._q.qsize()
+
+    def cancel(self):
+        """Cancels all queued tasks, running tasks finish but are not retried"""
+        self._cancelled.set()
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+            self._q.task_done()
+
+    def shutdown(self, wait=True):
+        """Stops the workers once queued tasks are done, or cancelled"""
         for _ in self._threads:
             self._q.put(None)
-        for t in self._threads:
-            t.join()
+        if wait:
+            for t in self._threads:
+                t.join()
 
     def wait(self):
         logging.info("Waiting for jobs to finish %s", self._q.qsize())
         self._q.join()
+
+    def _worker(self):
+        while True:
+            item = self._q.get()
+            try:
+                if item is None:
+                    break
+                future, fn, args, kwargs = item
+                # a submit blocked on a full queue can still get in during a cancel
+                if self._cancelled.is_set():
+                    future.cancel()
+                elif future.set_running_or_notify_cancel():
+                    self._run(future, fn, args, kwargs)
+            finally:
+                self._q.task_done()
+
+    def _run(self, future, fn, args, kwargs):
+        attempt = 0
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if (
+                    attempt >= self.retries
+                    or self._cancelled.is_set()
+                    or (self.retryable is not None and not self.retryable(e))
+                ):
+                    future.set_exception(e)
+                    return
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                logging.warning(
+                    "Task failed retrying in %ss (%s/%s): %s",
+                    delay,
+                    attempt,
+                    self.retries,
+                    e,
+                )
+                if self._cancelled.wait(delay):
+                    future.set_exception(e)
+                    return
+            else:
+                future.set_result(result)
+                return
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterates over iterable on a background thread so up to depth items are
+    ready before they are needed. Exceptions are raised in the consuming thread
+    """
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                q.put((item, None))
+        except Exception as e:
+            q.put((None, e))
+            return
+        q.put((done, None))
+
+    t = threading.Thread(target=produce, daemon=True)
+    t.start()
+    while True:
+        item, error = q.get()
+        if error is not None:
+            raise error
+        if item is done:
+            break
+        yield item
@@ -0,0 +1,127 @@
+import numpy as np
+
+
+class Positions:
+    """
+    Track positions, converted to the per frame dictionary layout when they are
+    written as json and to numpy columns when they are saved in a sidecar, each
+    only when it is needed
+    """
+
+    def __init__(self, columns=None, positions=None):
+        self._columns = columns
+        self._positions = positions
+
+    def __len__(self):
+        if self._positions is not None:
+            return len(self._positions)
+        return len(self._columns["x"])
+
+    @classmethod
+    def from_list(cls, positions):
+        """Wraps a list of track data positions in either the old
+        [frameTime, [left, top, right, bottom]] format or the dictionary format"""
+        return cls(positions=positions)
+
+    @property
+    def columns(self):
+        """Positions as numpy arrays of x, y, width, height and either frameTime
+        or order, mass and blank"""
+        if self._columns is None:
+            self._columns = to_columns(self._positions)
+        return self._columns
+
+    def to_dicts(self):
+        """Returns positions in the per frame dictionary layout"""
+        if self._positions is not None:
+            return to_dicts(self._positions)
+        keys = list(self.columns.keys())
+        # tolist converts to python types and masked values to None
+        values = [column.tolist() for column in self.columns.values()]
+        return [dict(zip(keys, row)) for row in zip(*values)]
+
+
+def is_old_format(positions):
+    return len(positions) > 0 and isinstance(positions[0], list)
+
+
+def to_dicts(positions):
+    """Maps a whole list of positions to the per frame dictionary layout, checking
+    the format once rather than for every position"""
+    if is_old_format(positions):
+        return [
+            {
+                "x": left,
+                "y": top,
+                "width": right - left,
+                "height": bottom - top,
+                "frameTime": frame_time,
+            }
+            for frame_time, (left, top, right, bottom) in positions
+        ]
+    return [
+        {
+            "x": position["x"],
+            "y": position["y"],
+            "width": position["width"],
+            "height": position["height"],
+            "order": (
+                position["frame_number"]
+                if "frame_number" in position
+                else position.get("order")
+            ),
+            "mass": position.get("mass"),
+            "blank": position.get("blank", False),
+        }
+        for position in positions
+    ]
+
+
+def to_columns(positions):
+    """Converts a list of positions to numpy columns"""
+    if is_old_format(positions):
+        left, top, right, bottom = (
+            column([position[1][i] for position in positions]) for i in range(4)
+        )
+        return {
+            "x": left,
+            "y": top,
+            "width": right - left,
+            "height": bottom - top,
+            "frameTime": column([position[0] for position in positions]),
+        }
+    return {
+        "x": column([position["x"] for position in positions]),
+        "y": column([position["y"] for position in positions]),
+        "width": column([position["width"] for position in positions]),
+        "height": column([position["height"] for position in positions]),
+        "order": optional_column(
+            [
+                (
+                    position["frame_number"]
+                    if "frame_number" in position
+                    else position.get("order")
+                )
+                for position in positions
+            ]
+        ),
+        "mass": optional_column([position.get("mass") for position in positions]),
+        "blank": column([position.get("blank", False) for position in positions]),
+    }
+
+
+def column(values):
+    """Creates an array of values. Mixed ints and floats are kept as python objects,
+    as a float array would write the ints as floats in the json"""
+    if len(set(map(type, values))) > 1:
+        return np.array(values, dtype=object)
+    return np.array(values)
+
+
+def optional_column(values):
+    """Creates a masked array where None values are masked"""
+    mask = [value is None for value in values]
+    data = column([value for value in values if value is not None])
+    filled = np.zeros(len(values), dtype=data.dtype if len(data) else float)
+    filled[np.logical_not(mask)] = data
+    return np.ma.array(filled, mask=mask)
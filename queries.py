@@ -0,0 +1,131 @@
+import json
+import logging
+import re
+import time
+
+import psycopg2
+
+# psycopg2 style named parameters, %(name)s
+PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+class Queries:
+    """
+    Runs SQL with psycopg2 style named parameters as server side prepared statements,
+    so each distinct query is parsed once per connection and only its parameters are
+    sent after that. Execution times are kept per query name.
+
+    With explain the first execution of each statement is also run with EXPLAIN
+    ANALYZE, logging its planning and execution times and the plan nodes that took
+    the longest
+    """
+
+    def __init__(self, conn, explain=False):
+        self.conn = conn
+        self.explain = explain
+        # sql -> (statement name, parameter names)
+        self._prepared = {}
+        self._statements = 0
+        self._explained = set()
+        # query name -> [executions, total seconds, max seconds]
+        self._stats = {}
+
+    def fetch_all(self, cur, name, sql, params):
+        """Executes sql with params as a prepared statement and returns all rows,
+        rolling back after an error so it can be retried"""
+        try:
+            statement, names = self._prepare(cur, name, sql)
+            execute = f"EXECUTE {statement}"
+            if names:
+                execute += " (" + ", ".join(["%s"] * len(names)) + ")"
+            values = [params[n] for n in names]
+            if self.explain and statement not in self._explained:
+                self._explained.add(statement)
+                self._explain(cur, statement, execute, values)
+            start = time.time()
+            cur.execute(execute, values)
+            rows = cur.fetchall()
+            self._record(name, time.time() - start)
+            return rows
+        except psycopg2.Error:
+            # prepare again under a new name in case the statement was lost
+            self._prepared.pop(sql, None)
+            if not self.conn.closed:
+                self.conn.rollback()
+            raise
+
+    def _prepare(self, cur, name, sql):
+        prepared = self._prepared.get(sql)
+        if prepared is not None:
+            return prepared
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        statement_sql = PARAMETER.sub(number, sql).replace("%%", "%")
+        self._statements += 1
+        statement = f"{name}_{self._statements}"
+        start = time.time()
+        cur.execute(f"PREPARE {statement} AS {statement_sql}")
+        logging.info("Prepared %s in %.3fs", statement, time.time() - start)
+        self._prepared[sql] = (statement, names)
+        return statement, names
+
+    def _explain(self, cur, name, execute, values):
+        cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {execute}", values)
+        row = cur.fetchone()
+        plan = list(row.values())[0] if isinstance(row, dict) else row[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        plan = plan[0]
+        logging.info(
+            "Query %s planning %.1fms execution %.1fms",
+            name,
+            plan.get("Planning Time", 0),
+            plan.get("Execution Time", 0),
+        )
+        nodes = sorted(plan_nodes(plan["Plan"]), key=lambda n: n[0], reverse=True)
+        for self_time, description in nodes[:5]:
+            logging.info("  %.1fms %s", self_time, description)
+
+    def _record(self, name, seconds):
+        stats = self._stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def log_stats(self):
+        for name, (count, total, longest) in sorted(self._stats.items()):
+            logging.info(
+                "Query %s ran %s times in %.1fs mean %.3fs max %.3fs",
+                name,
+                count,
+                total,
+                total / count,
+                longest,
+            )
+
+
+def plan_nodes(node):
+    """Yields the time spent in each plan node excluding its children, in ms, and a
+    description of the node"""
+    loops = node.get("Actual Loops", 1)
+    total = node.get("Actual Total Time", 0) * loops
+    children = node.get("Plans", [])
+    child_total = sum(
+        child.get("Actual Total Time", 0) * child.get("Actual Loops", 1)
+        for child in children
+    )
+    description = node["Node Type"]
+    if "Join Type" in node:
+        description += f" {node['Join Type']}"
+    if "Relation Name" in node:
+        description += f" on {node['Relation Name']}"
+    if "Alias" in node and node.get("Alias") != node.get("Relation Name"):
+        description += f" as {node['Alias']}"
+    yield max(total - child_total, 0), description
+    for child in children:
+        yield from plan_nodes(child)
@@ -0,0 +1,63 @@
+import hashlib
+import os
+from pathlib import Path
+
+CHUNK_SIZE = 64 * 1024
+PART_EXT = ".part"
+
+
+class IncompleteDownloadError(IOError):
+    """A download that ended short or corrupt, retrying resumes or restarts it"""
+
+
+def part_file(filename):
+    """Returns the path a download of filename is written to until it is complete"""
+    return Path(str(filename) + PART_EXT)
+
+
+def range_headers(part):
+    """Returns the offset to resume part from and the headers to request the rest"""
+    offset = part.stat().st_size if part.exists() else 0
+    if offset == 0:
+        return 0, {}
+    return offset, {"Range": f"bytes={offset}-"}
+
+
+def expected_size(headers, offset):
+    """Works out the full file size from a response's Content-Range or Content-Length"""
+    content_range = headers.get("Content-Range")
+    if content_range is not None and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total != "*":
+            return int(total)
+    length = headers.get("Content-Length")
+    if length is not None:
+        return offset + int(length)
+    return None
+
+
+def finish_part(part, filename, size=None, file_hash=None):
+    """Checks a downloaded part file against the expected size and sha1 file_hash,
+    then renames it to filename. A short part file is kept so it can be resumed,
+    a part file with the wrong hash is removed"""
+    part_size = part.stat().st_size
+    if size is not None and part_size != size:
+        raise IncompleteDownloadError(
+            f"{part} is {part_size} bytes but expected {size}"
+        )
+    if file_hash is not None:
+        digest = sha1_file(part)
+        if digest != file_hash:
+            part.unlink()
+            raise IncompleteDownloadError(
+                f"{part} has hash {digest} but expected {file_hash}"
+            )
+    os.replace(part, filename)
+
+
+def sha1_file(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
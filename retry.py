@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import aiohttp
+import requests
+
+from resumable import IncompleteDownloadError
+
+# responses worth retrying, throttling and server side failures
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# boto error codes worth retrying, anything else like NoSuchKey is fatal
+RETRYABLE_S3_CODES = {
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "InternalError",
+    "ServiceUnavailable",
+}
+
+
+class RetryPolicy:
+    """
+    Retries calls that fail with a retryable error, waiting an exponential backoff
+    with full jitter between attempts, or Retry-After if the server gives one.
+
+    Retries are limited by a budget shared by every call through the policy, at most
+    min_retries plus budget_ratio of all calls, so a failing service isn't retried
+    into the ground. After breaker_threshold consecutive failed calls the circuit
+    opens and calls wait for breaker_reset seconds, then one call is let through to
+    test whether the service has recovered while the others keep waiting
+    """
+
+    def __init__(
+        self,
+        name,
+        retryable,
+        attempts=5,
+        base_delay=0.5,
+        max_delay=60,
+        budget_ratio=0.2,
+        min_retries=10,
+        breaker_threshold=10,
+        breaker_reset=30,
+    ):
+        self.name = name
+        self.retryable = retryable
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._retries = 0
+        self._failures = 0
+        self._opened_at = None
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            wait = self._before_call()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._after_failure(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self._after_success()
+                return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Same as call for a coroutine function"""
+        attempt = 0
+        while True:
+            wait = self._before_call()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._after_failure(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self._after_success()
+                return result
+
+    def _before_call(self):
+        """Returns 0 if the call can go ahead, or the seconds to wait before checking
+        again while the circuit is open"""
+        with self._lock:
+            if self._opened_at is not None:
+                remaining = self._opened_at + self.breaker_reset - time.time()
+                if remaining > 0:
+                    # check at least every second so waiting calls go soon after
+                    # the test call closes the circuit
+                    return min(remaining, 1)
+                # half open, let this call through and reopen if it fails
+                self._opened_at = time.time()
+            self._calls += 1
+            return 0
+
+    def _after_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("%s recovered, closing circuit", self.name)
+            self._failures = 0
+            self._opened_at = None
+
+    def _after_failure(self, error, attempt):
+        """Returns the seconds to wait before retrying, or None if error is fatal"""
+        if not self.retryable(error):
+            return None
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                if self._opened_at is None:
+                    logging.error(
+                        "%s failed %s times in a row, opening circuit for %ss",
+                        self.name,
+                        self._failures,
+                        self.breaker_reset,
+                    )
+                self._opened_at = time.time()
+                return None
+            if attempt + 1 >= self.attempts:
+                return None
+            if self._retries >= self.min_retries + self.budget_ratio * self._calls:
+                logging.warning("%s retry budget exhausted", self.name)
+                return None
+            self._retries += 1
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        logging.warning(
+            "%s failed retrying in %.1fs (%s/%s): %s",
+            self.name,
+            delay,
+            attempt + 1,
+            self.attempts - 1,
+            error,
+        )
+        return delay
+
+
+def http_status(error):
+    """Returns the HTTP status of a requests or aiohttp error response"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    return None
+
+
+def retry_after(error):
+    """Returns the Retry-After seconds of a throttled response"""
+    headers = None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        headers = error.response.headers
+    elif isinstance(error, aiohttp.ClientResponseError):
+        headers = error.headers
+    if not headers or headers.get("Retry-After") is None:
+        return None
+    try:
+        return float(headers["Retry-After"])
+    except ValueError:
+        return None
+
+
+def api_retryable(error):
+    """Connection failures, timeouts, throttling, server errors and incomplete
+    downloads are retried, other client errors are fatal"""
+    status = http_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+            IncompleteDownloadError,
+        ),
+    )
+
+
+def s3_retryable(error):
+    """Connection failures, throttling and server errors from boto3 are retried"""
+    import botocore.exceptions
+
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return code in RETRYABLE_S3_CODES or status in RETRYABLE_STATUS
+    return isinstance(
+        error,
+        (
+            botocore.exceptions.ConnectionError,
+            botocore.exceptions.HTTPClientError,
+            botocore.exceptions.IncompleteReadError,
+        ),
+    )
+
+
+def db_retryable(error):
+    """Operational errors such as statements cancelled by a conflict with recovery on
+    a replica are retried, errors in the query itself or a closed connection are fatal
+    """
+    import psycopg2
+
+    if not isinstance(error, psycopg2.OperationalError):
+        return False
+    cursor = getattr(error, "cursor", None)
+    return cursor is None or not cursor.connection.closed
@@ -0,0 +1,83 @@
+import io
+import zipfile
+
+import numpy as np
+
+from positions import Positions
+
+SIDECAR_EXT = ".npz"
+# fixed zip entry times so the same tracks always give the same bytes
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def save_sidecar(filename, tracks):
+    """Saves track positions as typed arrays in a compressed npz file so they can be
+    loaded without parsing the json metadata"""
+    with open(filename, "wb") as f:
+        f.write(sidecar_bytes(tracks))
+
+
+def sidecar_bytes(tracks):
+    """Returns the npz file of track positions. Unlike np.savez_compressed, which
+    stamps entries with the current time, the same tracks always give the same
+    bytes so unchanged sidecars can be found by their hash"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as npz:
+        for key, array in sidecar_arrays(tracks).items():
+            info = zipfile.ZipInfo(f"{key}.npy", date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with npz.open(info, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def sidecar_arrays(tracks):
+    arrays = {
+        "tracks": np.array([track["id"] for track in tracks], dtype=np.int64),
+        "start": np.array([nan_if_none(track.get("start")) for track in tracks]),
+        "end": np.array([nan_if_none(track.get("end")) for track in tracks]),
+    }
+    for track in tracks:
+        positions = track.get("positions")
+        if positions is None:
+            continue
+        if not isinstance(positions, Positions):
+            positions = Positions.from_list(positions)
+        for name, column in positions.columns.items():
+            key = f"positions/{track['id']}/{name}"
+            # mixed int and float columns are objects, npz needs typed arrays
+            if column.dtype == object:
+                column = column.astype(np.float64)
+            if isinstance(column, np.ma.MaskedArray):
+                arrays[key] = column.filled()
+                arrays[f"{key}.mask"] = np.ma.getmaskarray(column)
+            else:
+                arrays[key] = column
+    return arrays
+
+
+def load_sidecar(filename):
+    """Loads a sidecar saved by save_sidecar.
+
+    Returns a dictionary of track id to a dictionary of start, end and positions
+    """
+    with np.load(filename) as data:
+        tracks = {}
+        for track_id, start, end in zip(data["tracks"], data["start"], data["end"]):
+            tracks[int(track_id)] = {"start": start, "end": end, "positions": None}
+        columns = {}
+        for key in data.files:
+            if not key.startswith("positions/") or key.endswith(".mask"):
+                continue
+            _, track_id, name = key.split("/")
+            column = data[key]
+            if f"{key}.mask" in data.files:
+                column = np.ma.array(column, mask=data[f"{key}.mask"])
+            columns.setdefault(int(track_id), {})[name] = column
+        for track_id, track_columns in columns.items():
+            tracks[track_id]["positions"] = Positions(track_columns)
+    return tracks
+
+
+def nan_if_none(value):
+    return np.nan if value is None else value
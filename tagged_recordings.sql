@@ -48,9 +48,9 @@ from
 	inner join "Devices" as "Device" on
 		"Recording"."DeviceId" = "Device"."id"
 	where
-		(("Recording"."type" = '{}'
-			and ("Recording"."recordingDateTime" >= '{}')
-			and "Recording"."deletedAt" is null)
+		(("Recording"."type" = %(type)s
+			and ("Recording"."recordingDateTime" >= %(start_date)s)
+			and "Recording"."deletedAt" is null{after})
 		and ((
 		select
 			"Recording"."id"
@@ -77,7 +77,7 @@ from
 	order by
 		"recordingDateTime" desc,
 		"Recording"."id" desc
-	limit {} offset {}) as "Recording"
+	limit %(limit)s) as "Recording"
 left outer join "Groups" as "Group" on
 	"Recording"."GroupId" = "Group"."id"
 left outer join "Stations" as "Station" on
@@ -0,0 +1,61 @@
+"""
+Times converting track positions to the json dictionary layout with Positions
+against the per position map_position loop the direct exporter used before.
+
+Run from the repository root with:
+    python -m tests.benchmark_positions
+"""
+
+import json
+import timeit
+
+from positions import Positions
+from tests.test_positions import map_position
+
+TRACKS = 50
+FRAMES = 5000
+
+
+def dict_positions():
+    return [
+        {
+            "x": i % 160,
+            "y": i % 120,
+            "width": 10 + i % 7,
+            "height": 12.5,
+            "frame_number": i,
+            "mass": i if i % 3 else None,
+            "blank": i % 11 == 0,
+        }
+        for i in range(FRAMES)
+    ]
+
+
+def list_positions():
+    return [
+        [i / 9, [i % 160, i % 120, i % 160 + 10, i % 120 + 12]] for i in range(FRAMES)
+    ]
+
+
+def old(tracks):
+    return [[map_position(position) for position in track] for track in tracks]
+
+
+def new(tracks):
+    return [Positions.from_list(track).to_dicts() for track in tracks]
+
+
+def main():
+    for name, make in (("dict", dict_positions), ("list", list_positions)):
+        tracks = [make() for _ in range(TRACKS)]
+        assert json.dumps(old(tracks)) == json.dumps(new(tracks))
+        old_time = min(timeit.repeat(lambda: old(tracks), number=1, repeat=5))
+        new_time = min(timeit.repeat(lambda: new(tracks), number=1, repeat=5))
+        print(
+            f"{TRACKS}x{FRAMES} {name} positions: map_position {old_time:.3f}s "
+            f"Positions {new_time:.3f}s ({old_time / new_time:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
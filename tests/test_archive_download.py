@@ -0,0 +1,182 @@
+import hashlib
+
+import boto3
+import botocore.exceptions
+import pytest
+from moto import mock_aws
+
+import archive_download
+from archive_download import (
+    ArchiveDownloader,
+    QueueState,
+    archive_retryable,
+    transfer_settings,
+)
+from blob_store import BlobStore
+from retry import RetryPolicy
+
+BUCKET = "archive-bucket"
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def s3_config():
+    """Config for a moto S3, worker processes are forked so share the mock"""
+    with mock_aws():
+        config = {
+            "aws_access_key_id": "testing",
+            "aws_secret_access_key": "testing",
+            "region_name": "us-east-1",
+        }
+        boto3.client("s3", **config).create_bucket(Bucket=BUCKET)
+        yield config
+
+
+def put_object(s3_config, key, body):
+    boto3.client("s3", **s3_config).put_object(Bucket=BUCKET, Key=key, Body=body)
+    return hashlib.sha1(body).hexdigest()
+
+
+def archive(s3_config, tmp_path, **kwargs):
+    return ArchiveDownloader(
+        s3_config,
+        BUCKET,
+        num_processes=2,
+        state_file=tmp_path / archive_download.QUEUE_STATE_FILE,
+        **kwargs,
+    )
+
+
+def pending(tmp_path):
+    state = QueueState(tmp_path / archive_download.QUEUE_STATE_FILE)
+    files = state.pending()
+    state.close()
+    return files
+
+
+def client_error(code, status):
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "GetObject",
+    )
+
+
+class TestArchiveDownloader:
+    def test_multipart_object(self, s3_config, tmp_path):
+        body = bytes(range(256)) * (3 * MB // 256)
+        put_object(s3_config, "rec/multipart", body)
+        downloader = archive(
+            s3_config, tmp_path, transfer_settings=transfer_settings(1, 1, 4)
+        )
+        downloader.start()
+        downloader.put(str(tmp_path / "multipart.cptv"), "rec/multipart")
+        downloader.stop()
+        assert (tmp_path / "multipart.cptv").read_bytes() == body
+        assert downloader.metrics.count("downloaded") == 1
+        assert downloader.metrics.count("bytes") == len(body)
+        assert pending(tmp_path) == []
+
+    def test_missing_key_is_fatal(self, s3_config, tmp_path):
+        downloader = archive(s3_config, tmp_path)
+        downloader.start()
+        downloader.put(str(tmp_path / "missing.cptv"), "rec/missing")
+        downloader.stop()
+        assert downloader.metrics.count("fatal") == 1
+        assert downloader.metrics.count("failed") == 1
+        # retrying on resume would fail the same way
+        assert pending(tmp_path) == []
+        assert not (tmp_path / "missing.cptv").exists()
+
+    def test_transient_failure_stays_journaled(self, s3_config, tmp_path, monkeypatch):
+        def throttled(*args):
+            raise client_error("SlowDown", 503)
+
+        # the forked workers inherit the patched module
+        monkeypatch.setattr(archive_download, "download_archive_file", throttled)
+        monkeypatch.setattr(
+            archive_download, "s3_retry", RetryPolicy("Test", archive_retryable, 1)
+        )
+        filename = str(tmp_path / "throttled.cptv")
+        downloader = archive(s3_config, tmp_path)
+        downloader.start()
+        downloader.put(filename, "rec/throttled", "hash")
+        downloader.stop()
+        assert downloader.metrics.count("failed") == 1
+        assert downloader.metrics.count("fatal") == 0
+        assert pending(tmp_path) == [(filename, "rec/throttled", "hash")]
+
+    def test_start_requeues_pending(self, s3_config, tmp_path):
+        body = b"resumed recording"
+        put_object(s3_config, "rec/resumed", body)
+        saved = tmp_path / "saved.cptv"
+        saved.write_bytes(b"saved before the crash")
+        state = QueueState(tmp_path / archive_download.QUEUE_STATE_FILE)
+        state.add((str(tmp_path / "resumed.cptv"), "rec/resumed", None))
+        state.add((str(saved), "rec/saved", None))
+        state.close()
+
+        downloader = archive(s3_config, tmp_path)
+        downloader.start()
+        downloader.stop()
+        assert (tmp_path / "resumed.cptv").read_bytes() == body
+        # already saved files are dropped from the journal without downloading
+        assert downloader.metrics.count("downloaded") == 1
+        assert pending(tmp_path) == []
+
+    def test_put_ignores_queued_files(self, s3_config, tmp_path):
+        put_object(s3_config, "rec/1", b"recording")
+        downloader = archive(s3_config, tmp_path)
+        downloader.state.add((str(tmp_path / "1.cptv"), "rec/1", None))
+        downloader.put(str(tmp_path / "1.cptv"), "rec/1")
+        assert downloader.metrics.count("queued") == 0
+        downloader.start()
+        downloader.stop()
+
+    def test_blob_store_link(self, s3_config, tmp_path):
+        body = b"recording shared by two folders"
+        file_hash = put_object(s3_config, "rec/shared", body)
+        store = tmp_path / "store"
+        downloader = archive(s3_config, tmp_path, blob_store_dir=store)
+        downloader.start()
+        downloader.put(str(tmp_path / "first.cptv"), "rec/shared", file_hash)
+        downloader.stop()
+
+        downloader = archive(s3_config, tmp_path, blob_store_dir=store)
+        downloader.start()
+        downloader.put(str(tmp_path / "second.cptv"), "rec/shared", file_hash)
+        downloader.stop()
+        assert downloader.metrics.count("linked") == 1
+        assert downloader.metrics.count("downloaded") == 0
+        assert (tmp_path / "second.cptv").read_bytes() == body
+        assert BlobStore(store).path(file_hash).stat().st_nlink == 3
+
+    def test_cancel(self, s3_config, tmp_path):
+        put_object(s3_config, "rec/1", b"recording")
+        downloader = archive(s3_config, tmp_path)
+        downloader.start()
+        downloader.put(str(tmp_path / "1.cptv"), "rec/1")
+        # returns without waiting for the workers to finish the queue
+        downloader.cancel()
+        assert all(not p.is_alive() for p in downloader._processes)
+
+
+class TestArchiveRetryable:
+    def test_classification(self):
+        assert archive_retryable(client_error("SlowDown", 503))
+        assert archive_retryable(OSError("disk full"))
+        assert not archive_retryable(client_error("NoSuchKey", 404))
+        assert not archive_retryable(client_error("AccessDenied", 403))
+
+
+class TestBlobStore:
+    def test_add_verifies_hash(self, tmp_path):
+        store = BlobStore(tmp_path / "store")
+        filename = tmp_path / "rec.cptv"
+        filename.write_bytes(b"data")
+        store.add("0" * 40, filename, verify=True)
+        assert not store.path("0" * 40).exists()
+        file_hash = hashlib.sha1(b"data").hexdigest()
+        store.add(file_hash, filename, verify=True)
+        assert store.link(file_hash, tmp_path / "linked.cptv")
+        assert (tmp_path / "linked.cptv").read_bytes() == b"data"
+        assert not store.link("1" * 40, tmp_path / "missing.cptv")
@@ -0,0 +1,143 @@
+import datetime
+import importlib.util
+import json
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+from dateutil.parser import parse as parse_date
+
+ROOT = Path(__file__).parent.parent
+
+# the exporter is a script, so it is loaded from its file
+spec = importlib.util.spec_from_file_location(
+    "cptv_download_direct", ROOT / "cptv-download-direct.py"
+)
+direct = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(direct)
+
+
+class TestShardEndDate:
+    def test_saved_for_resume(self, tmp_path):
+        start_date = parse_date("2020-01-01")
+        args = Namespace(resume=False, shards=3)
+        end_date = direct.shard_end_date(tmp_path, args, start_date)
+        args.resume = True
+        assert direct.shard_end_date(tmp_path, args, start_date) == end_date
+
+    def test_resume_from_any_shard_checkpoint(self, tmp_path):
+        end_date = "2024-05-01T00:00:00"
+        checkpoint = tmp_path / direct.SHARD_CHECKPOINT_FILE.format(shard=2, shards=3)
+        checkpoint.write_text(json.dumps({"shard": {"end_date": end_date}}))
+        args = Namespace(resume=True, shards=3)
+        assert direct.shard_end_date(
+            tmp_path, args, parse_date("2020-01-01")
+        ) == parse_date(end_date)
+
+    def test_timezone_aware_start(self, tmp_path):
+        start_date = parse_date("2020-01-01T00:00:00+13:00")
+        args = Namespace(resume=False, shards=2)
+        end_date = direct.shard_end_date(tmp_path, args, start_date)
+        assert end_date - start_date > datetime.timedelta(0)
+
+
+def row(rec_id, minute):
+    return {
+        "id": rec_id,
+        "recordingDateTime": datetime.datetime(2024, 1, 1, 0, minute),
+    }
+
+
+class TestCheckpoint:
+    def test_resume_from_saved(self, tmp_path):
+        checkpoint = tmp_path / direct.CHECKPOINT_FILE
+        start_date = parse_date("2020-01-01")
+        last_key = direct.page_key([row(1, 5), row(7, 3)])
+        direct.save_checkpoint(checkpoint, "thermalRaw", start_date, last_key)
+        assert direct.resume_key(checkpoint, "thermalRaw", start_date) == (
+            "2024-01-01T00:03:00",
+            7,
+        )
+
+    def test_no_checkpoint(self, tmp_path):
+        checkpoint = tmp_path / direct.CHECKPOINT_FILE
+        start_date = parse_date("2020-01-01")
+        assert direct.resume_key(checkpoint, "thermalRaw", start_date) is None
+
+    @pytest.mark.parametrize(
+        "rec_type, start_date, shard",
+        [
+            ("audio", "2020-01-01", None),
+            ("thermalRaw", "2021-01-01", None),
+            ("thermalRaw", "2020-01-01", {"by": "id", "shard": 1, "shards": 2}),
+        ],
+    )
+    def test_mismatch_refused(self, tmp_path, rec_type, start_date, shard):
+        checkpoint = tmp_path / direct.CHECKPOINT_FILE
+        direct.save_checkpoint(
+            checkpoint,
+            "thermalRaw",
+            parse_date("2020-01-01"),
+            ("2024-01-01T00:03:00", 7),
+            {"by": "id", "shard": 0, "shards": 2} if shard else None,
+        )
+        with pytest.raises(SystemExit):
+            direct.resume_key(checkpoint, rec_type, parse_date(start_date), shard)
+
+
+class TestRecordingQuery:
+    def test_first_page(self):
+        sql, params = direct.recording_query(
+            "where true{after}", "thermalRaw", "start", 200, None, ("", {})
+        )
+        assert sql == "where true"
+        assert params == {"type": "thermalRaw", "start_date": "start", "limit": 200}
+
+    def test_after_resume(self):
+        shard = direct.shard_clause("id", 1, 4, None, None)
+        sql, params = direct.recording_query(
+            "where true{after}",
+            "thermalRaw",
+            "start",
+            200,
+            ("2024-01-01T00:03:00", 7),
+            shard,
+        )
+        assert sql == "where true" + direct.SHARD_ID_CLAUSE + direct.KEYSET_CLAUSE
+        assert params["after_time"] == "2024-01-01T00:03:00"
+        assert params["after_id"] == 7
+        assert params["shards"] == 4 and params["shard"] == 1
+
+
+class TestShardClause:
+    def test_date_ranges(self):
+        start = datetime.datetime(2024, 1, 1)
+        end = datetime.datetime(2024, 1, 4)
+        clauses = [direct.shard_clause("date", s, 3, start, end) for s in range(3)]
+        for shard, (clause, params) in enumerate(clauses):
+            assert params["shard_from"] == start + datetime.timedelta(days=shard)
+        assert clauses[0][1]["shard_to"] == clauses[1][1]["shard_from"]
+        assert clauses[1][1]["shard_to"] == clauses[2][1]["shard_from"]
+        # the last range is open ended so recordings after the end date are included
+        assert "shard_to" not in clauses[2][1]
+        assert direct.SHARD_TO_CLAUSE not in clauses[2][0]
+
+    def test_id(self):
+        clause, params = direct.shard_clause("id", 2, 3, None, None)
+        assert clause == direct.SHARD_ID_CLAUSE
+        assert params == {"shards": 3, "shard": 2}
+
+
+class TestCursorPages:
+    def test_recordings_not_split(self):
+        # several tag rows per recording
+        rows = [row(rec_id, rec_id) for rec_id in [1, 1, 2, 3, 3, 3, 4, 5, 5]]
+        pages = list(direct.cursor_pages(iter(rows), 2))
+        assert [[r["id"] for r in page] for page in pages] == [
+            [1, 1, 2],
+            [3, 3, 3, 4],
+            [5, 5],
+        ]
+
+    def test_empty(self):
+        assert list(direct.cursor_pages(iter([]), 2)) == []
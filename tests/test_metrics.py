@@ -0,0 +1,15 @@
+from metrics import Metrics, skipped_summary
+
+
+class TestMetrics:
+    def test_skipped_by_reason(self):
+        metrics = Metrics()
+        metrics.inc("skipped", label="unchanged")
+        metrics.inc("skipped", 2, label="ignored tag")
+        metrics.inc("processed")
+        counters, _, _ = metrics._snapshot()
+        assert skipped_summary(counters) == "3 (ignored tag 2, unchanged 1)"
+
+    def test_nothing_skipped(self):
+        counters, _, _ = Metrics()._snapshot()
+        assert skipped_summary(counters) == "0"
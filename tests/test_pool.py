@@ -0,0 +1,108 @@
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+
+from pool import Pool, prefetch
+
+
+class Flaky:
+    """Raises error the first failures calls"""
+
+    def __init__(self, failures, error):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return self.calls
+
+
+class TestPool:
+    def test_shutdown_waits_for_tasks(self):
+        pool = Pool(2)
+        futures = [pool.submit(lambda i=i: i * 2) for i in range(10)]
+        pool.shutdown()
+        assert [f.result(0) for f in futures] == [i * 2 for i in range(10)]
+        assert not any(t.is_alive() for t in pool._threads)
+
+    def test_retry(self):
+        flaky = Flaky(2, ValueError("flaky"))
+        with Pool(1, retries=2, backoff=0) as pool:
+            future = pool.submit(flaky)
+        assert future.result(0) == 3
+
+    def test_retries_exhausted(self):
+        flaky = Flaky(5, ValueError("flaky"))
+        with Pool(1, retries=2, backoff=0) as pool:
+            future = pool.submit(flaky)
+        with pytest.raises(ValueError):
+            future.result(0)
+        assert flaky.calls == 3
+
+    def test_not_retryable(self):
+        flaky = Flaky(1, KeyError("fatal"))
+        retryable = lambda e: isinstance(e, ValueError)
+        with Pool(1, retries=2, backoff=0, retryable=retryable) as pool:
+            future = pool.submit(flaky)
+        with pytest.raises(KeyError):
+            future.result(0)
+        assert flaky.calls == 1
+
+    def test_cancel_while_submit_blocked(self):
+        release = threading.Event()
+        pool = Pool(1, max_queued=1)
+        running = pool.submit(release.wait)
+        queued = pool.submit(lambda: "queued")
+        blocked = []
+
+        def submit():
+            try:
+                blocked.append(pool.submit(lambda: "blocked"))
+            except CancelledError:
+                blocked.append(None)
+
+        producer = threading.Thread(target=submit)
+        producer.start()
+        producer.join(0.2)
+        # the queue is full so the producer waits for space
+        assert producer.is_alive()
+        pool.cancel()
+        producer.join(5)
+        assert not producer.is_alive()
+        release.set()
+        pool.shutdown()
+        assert running.result(0)
+        assert queued.cancelled()
+        assert blocked[0] is None or blocked[0].cancelled()
+        with pytest.raises(CancelledError):
+            pool.submit(lambda: "after cancel")
+
+    def test_exception_in_with_block_cancels(self):
+        release = threading.Event()
+        threading.Timer(0.2, release.set).start()
+        with pytest.raises(RuntimeError):
+            with Pool(1) as pool:
+                pool.submit(release.wait, 5)
+                queued = pool.submit(lambda: "queued")
+                raise RuntimeError()
+        assert queued.cancelled()
+
+
+class TestPrefetch:
+    def test_items(self):
+        assert list(prefetch(range(5), 2)) == list(range(5))
+
+    def test_error_raised_in_consumer(self):
+        def items():
+            yield 1
+            raise ValueError("query failed")
+
+        consumed = []
+        with pytest.raises(ValueError):
+            for item in prefetch(items()):
+                consumed.append(item)
+        assert consumed == [1]
@@ -0,0 +1,88 @@
+import json
+
+import numpy as np
+
+from positions import Positions
+from sidecar import save_sidecar, load_sidecar, sidecar_bytes
+
+
+def map_position(position):
+    """The per position mapping cptv-download-direct.py used before Positions"""
+    if isinstance(position, list):
+        return {
+            "x": position[1][0],
+            "y": position[1][1],
+            "width": position[1][2] - position[1][0],
+            "height": position[1][3] - position[1][1],
+            "frameTime": position[0],
+        }
+    return {
+        "x": position["x"],
+        "y": position["y"],
+        "width": position["width"],
+        "height": position["height"],
+        "order": (
+            position["frame_number"]
+            if "frame_number" in position
+            else position.get("order")
+        ),
+        "mass": position.get("mass", None),
+        "blank": position.get("blank", False),
+    }
+
+
+def assert_same_json(positions):
+    expected = json.dumps([map_position(position) for position in positions])
+    assert json.dumps(Positions.from_list(positions).to_dicts()) == expected
+    # and through the numpy columns saved in sidecars
+    columns = Positions.from_list(positions).columns
+    assert json.dumps(Positions(columns).to_dicts()) == expected
+
+
+class TestPositions:
+    def test_dict_positions(self):
+        assert_same_json(
+            [
+                {"x": 1, "y": 2, "width": 3, "height": 4, "frame_number": 1},
+                {"x": 2, "y": 3, "width": 3, "height": 4, "order": 2, "mass": 10},
+                {"x": 3, "y": 4, "width": 3, "height": 4, "blank": True},
+            ]
+        )
+
+    def test_mixed_int_and_float(self):
+        assert_same_json(
+            [
+                {"x": 1, "y": 2.5, "width": 3, "height": 4, "mass": 1},
+                {"x": 1.5, "y": 2, "width": 3.0, "height": 4, "mass": 2.5},
+                {"x": 2, "y": 2, "width": 3, "height": 4, "mass": None},
+            ]
+        )
+
+    def test_list_positions(self):
+        assert_same_json([[0.1, [1, 2, 10, 12]], [0.2, [1.5, 2, 10, 12.5]]])
+        assert_same_json([[0, [1, 2, 10, 12]], [1, [2, 3, 11, 13]]])
+
+    def test_empty(self):
+        assert Positions.from_list([]).to_dicts() == []
+
+    def test_sidecar_round_trip(self, tmp_path):
+        positions = Positions.from_list(
+            [
+                {"x": 1, "y": 2, "width": 3, "height": 4, "mass": None},
+                {"x": 1.5, "y": 2, "width": 3, "height": 4, "mass": 5},
+            ]
+        )
+        filename = tmp_path / "rec.npz"
+        save_sidecar(
+            filename, [{"id": 7, "start": 0, "end": 1, "positions": positions}]
+        )
+        loaded = load_sidecar(filename)[7]["positions"].columns
+        np.testing.assert_array_equal(loaded["x"], [1, 1.5])
+        assert loaded["mass"].mask.tolist() == [True, False]
+
+    def test_sidecar_bytes_unchanged(self):
+        tracks = [
+            {"id": 1, "start": 0, "end": 2, "positions": [[0.1, [1, 2, 10, 12]]]},
+            {"id": 2, "start": 1, "end": None, "positions": None},
+        ]
+        assert sidecar_bytes(tracks) == sidecar_bytes(tracks)
@@ -0,0 +1,56 @@
+import hashlib
+
+import pytest
+
+from resumable import (
+    IncompleteDownloadError,
+    expected_size,
+    finish_part,
+    part_file,
+    range_headers,
+)
+
+
+class TestResumable:
+    def test_expected_size(self):
+        assert expected_size({"Content-Length": "10"}, 0) == 10
+        assert expected_size({"Content-Length": "10"}, 5) == 15
+        assert expected_size({"Content-Range": "bytes 5-14/15"}, 5) == 15
+        assert (
+            expected_size({"Content-Range": "bytes 5-14/*", "Content-Length": "10"}, 5)
+            == 15
+        )
+        assert expected_size({}, 0) is None
+
+    def test_range_headers(self, tmp_path):
+        part = part_file(tmp_path / "rec.cptv")
+        assert range_headers(part) == (0, {})
+        part.write_bytes(b"12345")
+        assert range_headers(part) == (5, {"Range": "bytes=5-"})
+
+    def test_finish_part(self, tmp_path):
+        filename = tmp_path / "rec.cptv"
+        part = part_file(filename)
+        part.write_bytes(b"data")
+        finish_part(part, filename, 4, hashlib.sha1(b"data").hexdigest())
+        assert filename.read_bytes() == b"data"
+        assert not part.exists()
+
+    def test_finish_part_short(self, tmp_path):
+        filename = tmp_path / "rec.cptv"
+        part = part_file(filename)
+        part.write_bytes(b"da")
+        with pytest.raises(IncompleteDownloadError):
+            finish_part(part, filename, 4)
+        # kept so the download can be resumed
+        assert part.read_bytes() == b"da"
+        assert not filename.exists()
+
+    def test_finish_part_bad_hash(self, tmp_path):
+        filename = tmp_path / "rec.cptv"
+        part = part_file(filename)
+        part.write_bytes(b"dada")
+        with pytest.raises(IncompleteDownloadError):
+            finish_part(part, filename, 4, hashlib.sha1(b"data").hexdigest())
+        assert not part.exists()
+        assert not filename.exists()
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+import requests
+
+from resumable import IncompleteDownloadError
+from retry import RetryPolicy, api_retryable, retry_after, s3_retryable
+
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+def s3_error(code, status):
+    import botocore.exceptions
+
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+        "GetObject",
+    )
+
+
+class Flaky:
+    """Raises errors[n] on the nth call, returning "ok" once they run out"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def policy(**kwargs):
+    return RetryPolicy("Test", api_retryable, base_delay=0, **kwargs)
+
+
+class TestClassification:
+    def test_api_retryable(self):
+        assert api_retryable(http_error(503))
+        assert api_retryable(http_error(429))
+        assert not api_retryable(http_error(404))
+        assert not api_retryable(http_error(403))
+        assert api_retryable(requests.ConnectionError())
+        assert api_retryable(requests.Timeout())
+        assert api_retryable(IncompleteDownloadError())
+        assert not api_retryable(ValueError())
+
+    def test_s3_retryable(self):
+        assert s3_retryable(s3_error("SlowDown", 503))
+        assert s3_retryable(s3_error("Unknown", 500))
+        assert not s3_retryable(s3_error("NoSuchKey", 404))
+        assert not s3_retryable(s3_error("AccessDenied", 403))
+
+    def test_retry_after(self):
+        assert retry_after(http_error(429, {"Retry-After": "3"})) == 3
+        assert retry_after(http_error(429, {"Retry-After": "soon"})) is None
+        assert retry_after(http_error(503)) is None
+
+
+class TestRetryPolicy:
+    def test_retries_retryable(self):
+        flaky = Flaky(http_error(503), requests.ConnectionError())
+        assert policy().call(flaky) == "ok"
+        assert flaky.calls == 3
+
+    def test_fatal_not_retried(self):
+        flaky = Flaky(http_error(404))
+        with pytest.raises(requests.HTTPError):
+            policy().call(flaky)
+        assert flaky.calls == 1
+
+    def test_attempts(self):
+        flaky = Flaky(*[http_error(503)] * 5)
+        with pytest.raises(requests.HTTPError):
+            policy(attempts=3).call(flaky)
+        assert flaky.calls == 3
+
+    def test_budget(self):
+        retry = policy(min_retries=2, budget_ratio=0)
+        flaky = Flaky(*[http_error(503)] * 3)
+        with pytest.raises(requests.HTTPError):
+            retry.call(flaky)
+        # the first call and the two retries the budget allows
+        assert flaky.calls == 3
+        # the budget is shared, so the next call isn't retried at all
+        flaky = Flaky(http_error(503))
+        with pytest.raises(requests.HTTPError):
+            retry.call(flaky)
+        assert flaky.calls == 1
+
+    def test_call_async(self):
+        async def flaky(errors):
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        retry = policy()
+        assert asyncio.run(retry.call_async(flaky, [http_error(503)])) == "ok"
+
+
+class TestCircuitBreaker:
+    def test_open_half_open_close(self):
+        retry = policy(attempts=1, breaker_threshold=2, breaker_reset=0.3)
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                retry.call(Flaky(http_error(503)))
+        assert retry._opened_at is not None
+
+        # calls wait for the circuit instead of failing, then test the service
+        start = time.time()
+        assert retry.call(Flaky()) == "ok"
+        assert time.time() - start >= 0.25
+        assert retry._opened_at is None
+
+        # once closed calls go straight through
+        start = time.time()
+        assert retry.call(Flaky()) == "ok"
+        assert time.time() - start < 0.1
+
+    def test_half_open_failure_reopens(self):
+        retry = policy(attempts=1, breaker_threshold=1, breaker_reset=0.2)
+        with pytest.raises(requests.HTTPError):
+            retry.call(Flaky(http_error(503)))
+        opened_at = retry._opened_at
+        with pytest.raises(requests.HTTPError):
+            retry.call(Flaky(http_error(503)))
+        assert retry._opened_at > opened_at
+
+    def test_success_resets_failures(self):
+        retry = policy(attempts=1, breaker_threshold=2)
+        with pytest.raises(requests.HTTPError):
+            retry.call(Flaky(http_error(503)))
+        retry.call(Flaky())
+        with pytest.raises(requests.HTTPError):
+            retry.call(Flaky(http_error(503)))
+        assert retry._opened_at is None
+
+    def test_fatal_errors_dont_open(self):
+        retry = policy(attempts=1, breaker_threshold=1)
+        with pytest.raises(requests.HTTPError):
+            retry.call(Flaky(http_error(404)))
+        assert retry._opened_at is None
@@ -22,5 +22,5 @@ left outer join "TrackTags" as "TrackTags" on
 left outer join "Users" as "TrackTags->User" on
 	"TrackTags"."UserId" = "TrackTags->User"."id"
 where
-	("Track"."RecordingId" in ({})
+	("Track"."RecordingId" = any(%(rec_ids)s)
 		and "Track"."archivedAt" is null);